@@ -71,6 +71,7 @@ class NorlessConfig:
     quiet: bool
     app_lock: FileLockT
     one_thread: bool
+    use_asyncio: bool
 
     def __init__(
         self,
@@ -79,14 +80,17 @@ class NorlessConfig:
         account: str | None = None,
         maildir: str | None = None,
         one_thread: bool = False,
+        use_asyncio: bool = False,
         quiet: bool = False,
         debug: bool = False,
     ) -> None:
         self.raw = load_toml(fname)
         self.state_dir = os.path.expanduser(self.raw.state_dir)
         self.timeout = self.raw.timeout
+        self.spool_threshold = self.raw.spool_threshold
         self.debug = self.raw.debug or debug
         self.one_thread = one_thread
+        self.use_asyncio = use_asyncio
         self.quiet = quiet
         self.app_lock = FileLock(os.path.join(self.state_dir, '.norless-lock'))
 
@@ -101,6 +105,9 @@ class NorlessConfig:
                 self.raw.trash_maildir,
                 None,
                 False,
+                'none',
+                False,
+                'none',
             )
 
         self.accounts: dict[str, ImapBox] = {}
@@ -123,6 +130,8 @@ class NorlessConfig:
                 os.path.expanduser(cfg.cafile) if cfg.cafile else None,
                 self.debug and 9 or 0,
                 xoauth2,
+                cfg.compress,
+                cfg.connections,
             )
             box.name = cfg.name
             box.from_addr = cfg.from_addr
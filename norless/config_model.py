@@ -1,5 +1,26 @@
 from dataclasses import dataclass
-from .schema import field, as_kv, as_list, optfield
+
+from .maildir import COMPRESSIONS, FSYNC_MODES
+from .schema import as_kv, as_list, field, optfield
+
+
+def fsync_mode(value: str) -> str:
+    if value not in FSYNC_MODES:
+        raise ValueError(f'must be one of {", ".join(FSYNC_MODES)}')
+    return value
+
+
+def compression_mode(value: str) -> str:
+    if value not in COMPRESSIONS:
+        raise ValueError(f'must be one of {", ".join(COMPRESSIONS)}')
+    return value
+
+
+def connection_count(value: int) -> int:
+    value = int(value)
+    if value < 1:
+        raise ValueError('must be at least 1')
+    return value
 
 
 @dataclass
@@ -7,6 +28,13 @@ class MaildirConfig:
     name: str = field(str)
     _path: str | None = optfield(str, src='path')
     mark_as_seen: bool = field(bool, False)
+    # none, per-message, group or syncfs, see Maildir
+    fsync: str = field(fsync_mode, 'none')
+    # messages with identical content within this maildir share a file
+    # via hard links, see run.store_message
+    dedup: bool = field(bool, False)
+    # none, gzip or xz, applies to messages stored from now on
+    compression: str = field(compression_mode, 'none')
 
     @property
     def path(self) -> str:
@@ -29,6 +57,9 @@ class AccountConfig:
     host: str = field(str)
     port: int | None = optfield(int)
     cafile: str | None = optfield(str)
+    compress: bool = field(bool, True)
+    # max parallel connections used to sync folders of the account
+    connections: int = field(connection_count, 1)
 
     smtp_host: str = field(str)
     smtp_port: int | None = optfield(int)
@@ -48,6 +79,8 @@ class Config:
     timeout: int = field(int, 60)
     trash_maildir: str | None = optfield(str)
     debug: bool = field(bool, False)
+    # messages larger than this are streamed to disk instead of being buffered
+    spool_threshold: int = field(int, 1024 * 1024)
 
     maildirs: list[MaildirConfig] = field(as_list(MaildirConfig), src='maildir')
     accounts: list[AccountConfig] = field(as_list(AccountConfig), src='account')
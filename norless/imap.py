@@ -1,22 +1,32 @@
 from __future__ import annotations
 
+import select
 import socket
 import ssl
-
+import time
+from collections.abc import Iterator
 from functools import cached_property
 from hashlib import sha1
 from itertools import batched
 from ssl import SSLSocket
-from typing import TYPE_CHECKING, Iterator, NamedTuple, TypedDict
+from typing import TYPE_CHECKING, NamedTuple, TypedDict
 
-from .imap_client import Client
+from . import seqset
+from .imap_client import IDLE_TIMEOUT, Client, Spool, Value
 from .imap_client import Select as ImapSelect
-from .maildir import Message
+from .maildir import Headers, Message, TmpMessage
 from .utils import check_cert
 
 if TYPE_CHECKING:
     from .config import XOauth2Holder
 
+MAILBOX_CHANGES = b'EXISTS', b'EXPUNGE', b'FETCH'
+POLL_INTERVAL = 60
+
+INFO_FIELDS = b'(UID FLAGS BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'
+MESSAGE_FIELDS = b'(UID FLAGS BODY.PEEK[])'
+FETCH_BATCH = 100
+
 
 class Info(NamedTuple):
     uid: int
@@ -29,12 +39,14 @@ class Status(NamedTuple):
     messages: int
     unseen: int
     uidvalidity: int
+    highestmodseq: int | None = None
+    uidnext: int | None = None
 
 
 class MsgDict(TypedDict):
     uid: str
     flags: tuple[str, ...]
-    body: bytes
+    body: bytes | TmpMessage
 
 
 def get_cert(sock: SSLSocket) -> bytes:
@@ -43,7 +55,49 @@ def get_cert(sock: SSLSocket) -> bytes:
     return result
 
 
-def message_id(msg: Message) -> str:
+def make_info(item: dict[str, Value]) -> Info:
+    uid = int(item['UID'])  # type: ignore[arg-type]
+    flags = tuple(flag.decode('latin-1') for flag in item['FLAGS'])  # type: ignore[union-attr]
+    msg = Message(item['BODY'].replace(b'\r\n', b'\n'))  # type: ignore[union-attr]
+    return Info(uid, message_id(msg), flags, msg)
+
+
+def make_msg_dict(item: dict[str, Value]) -> MsgDict:
+    return {
+        'uid': item['UID'].decode('latin-1'),  # type: ignore[union-attr]
+        'flags': tuple(flag.decode('latin-1') for flag in item['FLAGS']),  # type: ignore[union-attr]
+        'body': item['BODY'],  # type: ignore[typeddict-item]
+    }
+
+
+def make_flags(items: list[dict[str, Value]]) -> dict[int, tuple[str, ...]]:
+    return {
+        int(item['UID']): tuple(flag.decode('latin-1') for flag in item['FLAGS'])  # type: ignore[arg-type, union-attr]
+        for item in items
+    }
+
+
+def make_status(item: dict[str, int]) -> Status:
+    return Status(
+        item['MESSAGES'],
+        item.get('UNSEEN', 0),
+        item['UIDVALIDITY'],
+        item.get('HIGHESTMODSEQ'),
+        item['UIDNEXT'],
+    )
+
+
+def status_items(condstore: bool) -> bytes:
+    if condstore:
+        return b'(MESSAGES UNSEEN UIDVALIDITY UIDNEXT HIGHESTMODSEQ)'
+    return b'(MESSAGES UNSEEN UIDVALIDITY UIDNEXT)'
+
+
+def xoauth2_payload(username: str, token: str) -> bytes:
+    return f'user={username}\x01auth=Bearer {token}\x01\x01'.encode()
+
+
+def message_id(msg: Message | Headers) -> str:
     msg_id = msg.get('message-id')
     if not msg_id:
         hsh = sha1(f'{msg["date"]}:{msg["from"]}:{msg["to"]}:{msg["subject"]}'.encode()).hexdigest()
@@ -67,6 +121,8 @@ class ImapBox:
         cafile: str | None = None,
         debug: int | None = None,
         xoauth2: XOauth2Holder | None = None,
+        compress: bool = True,
+        connections: int = 1,
     ) -> None:
         self.host = host
         self.port = port or (993 if ssl else 143)
@@ -77,41 +133,75 @@ class ImapBox:
         self.cafile = cafile
         self.debug = debug
         self.xoauth2 = xoauth2
+        self.compress = compress
+        self.connections = connections
 
         self.selected_folder = None
         self._selected: ImapSelect | None = None
 
+    def copy(self) -> ImapBox:
+        """Returns a not yet connected box with the same settings"""
+        box = ImapBox(
+            self.host,
+            self.username,
+            self.password,
+            self.port,
+            self.ssl,
+            self.fingerprint,
+            self.cafile,
+            self.debug,
+            self.xoauth2,
+            self.compress,
+            self.connections,
+        )
+        box.name = self.name
+        box.from_addr = self.from_addr
+        return box
+
     def get_fingerprint(self, cert: bytes) -> str:
         s = sha1(cert).hexdigest().upper()
         return ':'.join(s[i : i + 2] for i in range(0, len(s), 2))
 
+    def verify_cert(self, cert: bytes) -> None:
+        if self.fingerprint:
+            server_fingerprint = self.get_fingerprint(cert)
+            if server_fingerprint != self.fingerprint:
+                raise Exception(f'Mismatched fingerprint for {self.host} {server_fingerprint}')
+        elif self.cafile:
+            check_cert(ssl.DER_cert_to_PEM_cert(cert).encode(), self.cafile)
+
     @cached_property
     def client(self) -> Client:
         sock = socket.create_connection((self.host, self.port))
         if self.ssl:
             ctx = ssl.create_default_context()
             wrapped = ctx.wrap_socket(sock, server_hostname=self.host)
-            if self.fingerprint:
-                server_fingerprint = self.get_fingerprint(get_cert(wrapped))
-                if server_fingerprint != self.fingerprint:
-                    raise Exception(
-                        f'Mismatched fingerprint for {self.host} {server_fingerprint}'
-                    )
-            elif self.cafile:
-                cert = ssl.DER_cert_to_PEM_cert(get_cert(wrapped))
-                check_cert(cert.encode(), self.cafile)
+            self.verify_cert(get_cert(wrapped))
             sock = wrapped
 
         client = Client(sock)
         if self.xoauth2:
-            xo = 'user={}\x01auth=Bearer {}\x01\x01'.format(
-                self.username, self.xoauth2.get_token()
-            ).encode()
-            client.authenticate('XOAUTH2', xo)
+            client.authenticate('XOAUTH2', xoauth2_payload(self.username, self.xoauth2.get_token()))
         else:
             client.login(self.username.encode(), self.password.encode())
+
+        if client.has_capability(b'QRESYNC'):
+            client.enable(b'QRESYNC')
+        elif client.has_capability(b'CONDSTORE'):
+            client.enable(b'CONDSTORE')
+
+        if self.compress and client.has_capability(b'COMPRESS=DEFLATE'):
+            client.compress()
         return client
 
+    def close(self) -> None:
+        """Closes the connection, the next use of the box connects again"""
+        client = self.__dict__.pop('client', None)
+        self.selected_folder = None
+        self._selected = None
+        if client is not None:
+            client.close()
+
     def list_folders(self) -> list[tuple[str, str, str]]:
         result: list[tuple[str, str, str]] = []
         for flags, sep, name in self.client.list_folders():
@@ -130,13 +220,39 @@ class ImapBox:
     def get_status(self, folder: str) -> Status:
         self.select(folder)
         assert self._selected is not None
-        return Status(self._selected.exists, self._selected.unseen or 0, self._selected.uidvalidity)
+        return Status(
+            self._selected.exists,
+            self._selected.unseen or 0,
+            self._selected.uidvalidity,
+            self._selected.highestmodseq,
+            self._selected.uidnext,
+        )
+
+    def get_statuses(self, folders: list[str]) -> dict[str, Status]:
+        """STATUS of several folders without selecting them"""
+        client = self.client
+        items = status_items(client.has_capability(b'CONDSTORE'))
+        result = client.status([f.encode() for f in folders], items)
+        return {name: make_status(it) for name, it in zip(folders, result)}
 
     def select(self, name: str) -> None:
         if name != self.selected_folder:
             self._selected = self.client.select(name.encode())
             self.selected_folder = name
 
+    def select_search(self, name: str, criteria: bytes) -> list[int]:
+        """UID SEARCH in a folder, pipelined with SELECT if it is not selected yet"""
+        client = self.client
+        esearch = client.has_capability(b'ESEARCH')
+        if name == self.selected_folder:
+            return client.search(criteria, uid=True, esearch=esearch)
+
+        self._selected, result = client.select_search(
+            name.encode(), criteria, uid=True, esearch=esearch
+        )
+        self.selected_folder = name
+        return result
+
 
 class Folder:
     def __init__(self, box: ImapBox, name: str) -> None:
@@ -159,6 +275,14 @@ class Folder:
     def uidvalidity(self) -> int:
         return self.status.uidvalidity
 
+    @property
+    def highestmodseq(self) -> int | None:
+        return self.status.highestmodseq
+
+    @property
+    def uidnext(self) -> int | None:
+        return self.status.uidnext
+
     def select(self) -> None:
         self.box.select(self.name)
 
@@ -167,45 +291,74 @@ class Folder:
 
     def delete(self, uids: list[int]) -> None:
         self.select()
-        self.box.client.store(','.join(map(str, uids)).encode(), b'+FLAGS', b'(\\Deleted)', uid=True)
+        for query in seqset.split(uids):
+            self.box.client.store(query, b'+FLAGS', b'(\\Deleted)', uid=True)
 
     def seen(self, uids: list[int]) -> None:
         self.select()
-        self.box.client.store(','.join(map(str, uids)).encode(), b'+FLAGS', b'(\\Seen)', uid=True)
+        for query in seqset.split(uids):
+            self.box.client.store(query, b'+FLAGS', b'(\\Seen)', uid=True)
 
     def info(self, uids: list[int] | None = None, recent: int | None = None) -> Iterator[Info]:
         self.select()
-        request = b'(UID FLAGS BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'
 
         if uids is not None:
-            result = self.box.client.fetch(','.join(map(str, uids)).encode(), request, uid=True)
+            result = self.box.client.fetch_many(seqset.split(uids), INFO_FIELDS, uid=True)
         elif recent is not None:
             start, end = max(self.total - recent, 1), self.total
-            result = self.box.client.fetch(f'{start}:{end}'.encode(), request)
+            result = self.box.client.fetch_iter(f'{start}:{end}'.encode(), INFO_FIELDS)
         else:
-            result = self.box.client.fetch(b'1:*', request)
+            result = self.box.client.fetch_iter(b'1:*', INFO_FIELDS)
 
         for item in result:
-            uid = int(item['UID'])  # type: ignore[arg-type]
-            flags = tuple(flag.decode('latin-1') for flag in item['FLAGS'])  # type: ignore[union-attr]
-            msg = Message(item['BODY'].replace(b'\r\n', b'\n'))  # type: ignore[union-attr]
-            yield Info(uid, message_id(msg), flags, msg)
+            yield make_info(item)
 
-    def fetch_uids(self, uids: list[int]) -> Iterator[MsgDict]:
+    def fetch_uids(self, uids: list[int], spool: Spool | None = None) -> Iterator[MsgDict]:
+        """Fetches full messages, bodies accepted by spool come as its sinks"""
         if not uids:
             return
 
         self.select()
-        for batch in batched(uids, 100):
-            result = self.box.client.fetch(
-                ','.join(map(str, batch)).encode(), b'(UID FLAGS BODY.PEEK[])', uid=True
+        queries = (seqset.encode(batch) for batch in batched(uids, FETCH_BATCH))
+        result = self.box.client.fetch_many(queries, MESSAGE_FIELDS, uid=True, spool=spool)
+        for item in result:
+            yield make_msg_dict(item)
+
+    def wait_changes(self, timeout: float = IDLE_TIMEOUT, wakeup: int | None = None) -> bool:
+        """Blocks until the server reports folder changes
+
+        Uses IDLE if the server supports it and falls back to polling.
+        Returns False if nothing happened before timeout or before the
+        `wakeup` file descriptor became readable.
+        """
+        self.select()
+        client = self.box.client
+        if not client.has_capability(b'IDLE'):
+            delay = min(timeout, POLL_INTERVAL)
+            if wakeup is None:
+                time.sleep(delay)
+            else:
+                select.select([wakeup], [], [], delay)
+            changed = True
+        else:
+            changed = any(
+                line[1] == b'VANISHED' or (len(line) >= 3 and line[2] in MAILBOX_CHANGES)
+                for line in client.idle(timeout, wakeup)
             )
-            for item in result:
-                yield {
-                    'uid': item['UID'].decode('latin-1'),  # type: ignore[union-attr]
-                    'flags': tuple(flag.decode('latin-1') for flag in item['FLAGS']),  # type: ignore[union-attr]
-                    'body': item['BODY'],  # type: ignore[typeddict-item]
-                }
+
+        if changed:
+            # refresh SELECT data (UIDNEXT, HIGHESTMODSEQ) on the next sync
+            self.box.selected_folder = None
+        return changed
+
+    def changed_flags(self, modseq: int) -> tuple[dict[int, tuple[str, ...]], list[int]]:
+        """Returns flags of messages changed since modseq and expunged UIDs"""
+        self.select()
+        client = self.box.client
+        items, vanished = client.fetch_changed(
+            b'1:*', b'(UID FLAGS)', modseq, vanished=client.has_capability(b'QRESYNC')
+        )
+        return make_flags(items), vanished
 
     def get_flags(self, uids: list[int]) -> dict[int, tuple[str, ...]]:
         raise NotImplementedError('get_flags is not implemented in imap2 yet')
@@ -214,5 +367,6 @@ class Folder:
         raise NotImplementedError('append_messages is not implemented in imap2 yet')
 
     def uids_since(self, last_uid: int) -> list[int]:
-        self.select()
-        return [uid for uid in self.box.client.search(f'(UID {last_uid + 1}:*)'.encode(), uid=True) if uid > last_uid]
+        criteria = f'(UID {last_uid + 1}:*)'.encode()
+        uids = self.box.select_search(self.name, criteria)
+        return [uid for uid in uids if uid > last_uid]
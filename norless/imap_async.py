@@ -0,0 +1,396 @@
+"""asyncio counterparts of Client, ImapBox and Folder
+
+All sockets of a sync run share one event loop instead of a thread per
+connection. Protocol parsing is the same sans-IO Proto used by Client.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import ssl
+from collections import deque
+from collections.abc import AsyncIterator, Collection, Iterable
+from itertools import batched
+
+from sansproto import Chunk
+
+from . import seqset
+from .imap import (
+    FETCH_BATCH,
+    INFO_FIELDS,
+    MESSAGE_FIELDS,
+    ImapBox,
+    Info,
+    MsgDict,
+    Status,
+    make_flags,
+    make_info,
+    make_msg_dict,
+    make_status,
+    status_items,
+    xoauth2_payload,
+)
+from .imap_client import (
+    BUFSIZE,
+    PIPELINE_DEPTH,
+    ClientBase,
+    Response,
+    Select,
+    Spool,
+    Value,
+    changedsince,
+    quote,
+)
+
+
+class AsyncClient(ClientBase):
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        timeout: float | None = None,
+    ) -> None:
+        super().__init__()
+        self._reader = reader
+        self._writer = writer
+        # socket.setdefaulttimeout does not apply to asyncio streams
+        self.timeout = timeout
+
+    @classmethod
+    async def connect(
+        cls,
+        host: str,
+        port: int,
+        ssl_context: ssl.SSLContext | None = None,
+        timeout: float | None = None,
+    ) -> AsyncClient:
+        async with asyncio.timeout(timeout):
+            reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        client = cls(reader, writer, timeout)
+        await client._wait_response(b'*')
+        return client
+
+    def get_extra_info(self, name: str) -> object:
+        return self._writer.get_extra_info(name)
+
+    async def _recv(self) -> Chunk:
+        while True:
+            async with asyncio.timeout(self.timeout):
+                received = await self._reader.read(BUFSIZE)
+            if (data := self._decode_received(received)) is not None:
+                return data
+
+    async def _sendall(self, data: bytes) -> None:
+        self._writer.write(self._encode_sent(data))
+        async with asyncio.timeout(self.timeout):
+            await self._writer.drain()
+
+    async def _wait_response(self, tag: bytes | None = None) -> Response:
+        tag = tag or self._proto._current_tag
+        resp = self._proto.pop_response(tag)
+        while resp is None:
+            resp = self._proto.wait_response(await self._recv(), tag)
+        return resp
+
+    async def _send_command(self, cmd: str, data: Collection[bytes] = ()) -> bytes:
+        await self._sendall(self._proto.command(cmd, data))
+        return self._proto._current_tag
+
+    async def authenticate(self, mechanism: str, data: bytes) -> None:
+        await self._send_command('AUTHENTICATE', (mechanism.encode(),))
+        await self._wait_response(b'+')
+        await self._sendall(base64.b64encode(data) + b'\r\n')
+        await self._wait_response()
+        self._capabilities = None
+
+    async def login(self, username: bytes, password: bytes) -> None:
+        await self.command('LOGIN', (quote(username), quote(password)))
+        self._capabilities = None
+
+    async def capabilities(self) -> set[bytes]:
+        if self._capabilities is None:
+            return self._set_capabilities(await self.command('CAPABILITY'))
+        return self._capabilities
+
+    async def has_capability(self, name: bytes) -> bool:
+        return name.upper() in await self.capabilities()
+
+    async def enable(self, *capabilities: bytes) -> None:
+        await self.command('ENABLE', capabilities)
+
+    async def compress(self) -> None:
+        await self.command('COMPRESS', (b'DEFLATE',))
+        self._start_compression()
+
+    async def command(self, cmd: str, data: Collection[bytes] = (), uid: bool = False) -> Response:
+        await self.queue(cmd, data, uid)
+        return await self._wait_response()
+
+    async def queue(self, cmd: str, data: Collection[bytes] = (), uid: bool = False) -> bytes:
+        if uid:
+            cmd = 'UID ' + cmd
+        return await self._send_command(cmd, data)
+
+    async def result(self, tag: bytes) -> Response:
+        return await self._wait_response(tag)
+
+    async def pipeline(self, commands: Iterable[tuple[str, Collection[bytes]]]) -> list[Response]:
+        """Client.pipeline, the rest of commands are waited for if one fails"""
+        tags = [await self.queue(cmd, data) for cmd, data in commands]
+        result: list[Response] = []
+        try:
+            for tag in tags:
+                result.append(await self.result(tag))
+        except ValueError:
+            await self._discard(tags[len(result) :])
+            raise
+        return result
+
+    async def _discard(self, tags: Iterable[bytes]) -> None:
+        for tag in tags:
+            while self._proto.pending(tag):
+                try:
+                    await self._wait_response(tag)
+                except ValueError:
+                    pass
+
+    async def select(self, mailbox: bytes) -> Select:
+        return self._proto.collect_select(await self.command('SELECT', (quote(mailbox),)))
+
+    async def search(self, criteria: bytes, uid: bool = False, esearch: bool = False) -> list[int]:
+        if esearch:
+            criteria = b'RETURN (ALL) ' + criteria
+        return self._proto.collect_search(await self.command('SEARCH', (criteria,), uid=uid))
+
+    async def status(self, mailboxes: Iterable[bytes], items: bytes) -> list[dict[str, int]]:
+        responses = await self.pipeline(('STATUS', (quote(it), items)) for it in mailboxes)
+        return [self._proto.collect_status(it) for it in responses]
+
+    async def select_search(
+        self, mailbox: bytes, criteria: bytes, uid: bool = False, esearch: bool = False
+    ) -> tuple[Select, list[int]]:
+        if esearch:
+            criteria = b'RETURN (ALL) ' + criteria
+        select_resp, search_resp = await self.pipeline(
+            [
+                ('SELECT', (quote(mailbox),)),
+                ('UID SEARCH' if uid else 'SEARCH', (criteria,)),
+            ]
+        )
+        return (
+            self._proto.collect_select(select_resp),
+            self._proto.collect_search(search_resp),
+        )
+
+    async def fetch_many(
+        self,
+        queries: Iterable[bytes],
+        fields: bytes,
+        uid: bool = False,
+        depth: int = PIPELINE_DEPTH,
+        spool: Spool | None = None,
+    ) -> AsyncIterator[dict[str, Value]]:
+        """Yields FETCH items keeping up to `depth` FETCH commands in flight
+
+        Unlike Client.fetch_many an abandoned iterator does not drain pending
+        responses, consume it to the end before issuing other commands. They
+        are drained if a FETCH fails.
+        """
+        queries = iter(queries)
+        inflight: deque[bytes] = deque()
+        self._proto.spool = spool
+        try:
+            while True:
+                while len(inflight) < depth and (query := next(queries, None)) is not None:
+                    inflight.append(await self.queue('FETCH', (query, fields), uid=uid))
+
+                if not inflight:
+                    return
+
+                lines, status = self._proto.take_response(inflight[0])
+                for item in self._proto.iter_pairs('FETCH', lines, cmd_idx=2):
+                    yield item
+                if status is None:
+                    self._proto.send(await self._recv())
+                else:
+                    inflight.popleft()
+        except ValueError:
+            await self._discard(inflight)
+            raise
+        finally:
+            self._proto.spool = None
+
+    async def fetch_changed(
+        self, query: bytes, fields: bytes, modseq: int, vanished: bool = False
+    ) -> tuple[list[dict[str, Value]], list[int]]:
+        modifier = changedsince(modseq, vanished)
+        resp = await self.command('FETCH', (query, fields, modifier), uid=True)
+        items = self._proto.collect_pairs('FETCH', resp, cmd_idx=2)
+        return items, self._proto.collect_vanished(resp)
+
+    async def store(
+        self, query: bytes, modifier: bytes, flags: bytes, uid: bool = False
+    ) -> list[dict[str, Value]]:
+        resp = await self.command('STORE', (query, modifier, flags), uid=uid)
+        return self._proto.collect_pairs('FETCH', resp, cmd_idx=2)
+
+    async def close(self) -> None:
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+
+class AsyncImapBox:
+    """Async connection with settings of an ImapBox"""
+
+    def __init__(self, box: ImapBox, timeout: float | None = None) -> None:
+        self.box = box
+        self.timeout = timeout
+        self.name = box.name
+        self.connections = box.connections
+        self.selected_folder: str | None = None
+        self._selected: Select | None = None
+        self._client: AsyncClient | None = None
+
+    def copy(self) -> AsyncImapBox:
+        return AsyncImapBox(self.box, self.timeout)
+
+    async def client(self) -> AsyncClient:
+        if self._client is None:
+            self._client = await self._connect()
+        return self._client
+
+    async def _connect(self) -> AsyncClient:
+        box = self.box
+        ctx = ssl.create_default_context() if box.ssl else None
+        client = await AsyncClient.connect(box.host, box.port, ctx, self.timeout)
+        if ctx:
+            ssl_object = client.get_extra_info('ssl_object')
+            assert isinstance(ssl_object, ssl.SSLObject)
+            cert = ssl_object.getpeercert(True)
+            assert cert
+            await asyncio.to_thread(box.verify_cert, cert)
+
+        if box.xoauth2:
+            token = await asyncio.to_thread(box.xoauth2.get_token)
+            await client.authenticate('XOAUTH2', xoauth2_payload(box.username, token))
+        else:
+            await client.login(box.username.encode(), box.password.encode())
+
+        if await client.has_capability(b'QRESYNC'):
+            await client.enable(b'QRESYNC')
+        elif await client.has_capability(b'CONDSTORE'):
+            await client.enable(b'CONDSTORE')
+
+        if box.compress and await client.has_capability(b'COMPRESS=DEFLATE'):
+            await client.compress()
+        return client
+
+    def get_folder(self, name: str) -> AsyncFolder:
+        return AsyncFolder(self, name)
+
+    async def get_statuses(self, folders: list[str]) -> dict[str, Status]:
+        client = await self.client()
+        items = status_items(await client.has_capability(b'CONDSTORE'))
+        result = await client.status([f.encode() for f in folders], items)
+        return {name: make_status(it) for name, it in zip(folders, result)}
+
+    async def select(self, name: str) -> None:
+        if name != self.selected_folder:
+            self._selected = await (await self.client()).select(name.encode())
+            self.selected_folder = name
+
+    async def select_search(self, name: str, criteria: bytes) -> list[int]:
+        client = await self.client()
+        esearch = await client.has_capability(b'ESEARCH')
+        if name == self.selected_folder:
+            return await client.search(criteria, uid=True, esearch=esearch)
+
+        self._selected, result = await client.select_search(
+            name.encode(), criteria, uid=True, esearch=esearch
+        )
+        self.selected_folder = name
+        return result
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class AsyncFolder:
+    """Async Folder, status properties are valid after uids_since or select"""
+
+    def __init__(self, box: AsyncImapBox, name: str) -> None:
+        self.box = box
+        self.name = name
+
+    @property
+    def _selected(self) -> Select:
+        assert self.box._selected is not None and self.box.selected_folder == self.name
+        return self.box._selected
+
+    @property
+    def total(self) -> int:
+        return self._selected.exists
+
+    @property
+    def uidvalidity(self) -> int:
+        return self._selected.uidvalidity
+
+    @property
+    def highestmodseq(self) -> int | None:
+        return self._selected.highestmodseq
+
+    @property
+    def uidnext(self) -> int | None:
+        return self._selected.uidnext
+
+    async def select(self) -> None:
+        await self.box.select(self.name)
+
+    async def _store(self, uids: list[int], flags: bytes) -> None:
+        await self.select()
+        client = await self.box.client()
+        for query in seqset.split(uids):
+            await client.store(query, b'+FLAGS', flags, uid=True)
+
+    async def delete(self, uids: list[int]) -> None:
+        await self._store(uids, b'(\\Deleted)')
+
+    async def seen(self, uids: list[int]) -> None:
+        await self._store(uids, b'(\\Seen)')
+
+    async def info(self, uids: list[int]) -> AsyncIterator[Info]:
+        await self.select()
+        client = await self.box.client()
+        async for item in client.fetch_many(seqset.split(uids), INFO_FIELDS, uid=True):
+            yield make_info(item)
+
+    async def fetch_uids(
+        self, uids: list[int], spool: Spool | None = None
+    ) -> AsyncIterator[MsgDict]:
+        if not uids:
+            return
+
+        await self.select()
+        client = await self.box.client()
+        queries = (seqset.encode(batch) for batch in batched(uids, FETCH_BATCH))
+        async for item in client.fetch_many(queries, MESSAGE_FIELDS, uid=True, spool=spool):
+            yield make_msg_dict(item)
+
+    async def changed_flags(self, modseq: int) -> tuple[dict[int, tuple[str, ...]], list[int]]:
+        await self.select()
+        client = await self.box.client()
+        items, vanished = await client.fetch_changed(
+            b'1:*', b'(UID FLAGS)', modseq, vanished=await client.has_capability(b'QRESYNC')
+        )
+        return make_flags(items), vanished
+
+    async def uids_since(self, last_uid: int) -> list[int]:
+        criteria = f'(UID {last_uid + 1}:*)'.encode()
+        uids = await self.box.select_search(self.name, criteria)
+        return [uid for uid in uids if uid > last_uid]
@@ -1,11 +1,22 @@
-import socket
 import base64
 import re
+import select
+import socket
+import time
+import zlib
+from collections import deque
+from collections.abc import Callable, Collection, Iterable, Iterator
 from dataclasses import dataclass
-from sansproto import receiver, Reader, Parser, Emitter, Collector
-from typing import Collection
+from typing import Protocol
+
+from sansproto import Chunk, Emitter, Parser, Reader, ReaderCoro, receiver
+
+from . import seqset
 
 BUFSIZE = 64 * 1024
+PIPELINE_DEPTH = 4
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT = 29 * 60
 TOKENS_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|\(|\)|[^)\s]+')
 
 RESP_TEXT = b'OK', b'BAD', b'NO', b'PREAUTH', b'BYE'
@@ -14,6 +25,18 @@ BAD_RESP_TEXT = b'BAD', b'NO', b'BYE'
 Value = bytes | list['Value']
 
 
+class LiteralSink(Protocol):
+    """Receives a large literal chunk by chunk instead of it being buffered"""
+
+    def write(self, data: bytes, /) -> object: ...
+
+    def close(self) -> None: ...
+
+
+# returns a sink for a literal of given size or None to read it into memory
+Spool = Callable[[int], LiteralSink | None]
+
+
 @dataclass
 class Status:
     tag: bytes
@@ -42,8 +65,16 @@ class Select:
     readonly: bool | None = None
 
 
-def add_value(stack: list[list[Value]], value: Value) -> None:
-    stack[-1].append(value)
+@dataclass
+class ESearch:
+    min: int | None = None
+    max: int | None = None
+    count: int | None = None
+    all: bytes | None = None
+    uid: bool = False
+
+    def uids(self) -> list[int]:
+        return seqset.decode(self.all) if self.all else []
 
 
 def parse_resp_text(text: bytes) -> tuple[list[bytes], bytes]:
@@ -69,7 +100,7 @@ def parse_status(line: list[Value]) -> Status:
     return Status(
         tag=line[0],  # type: ignore[arg-type]
         kind=line[1],  # type: ignore[arg-type]
-        code=code[0] if code else b'', # type: ignore[arg-type]
+        code=code[0] if code else b'',  # type: ignore[arg-type]
         payload=code[1] if len(code) > 1 else b'',  # type: ignore[arg-type]
         text=line[3],  # type: ignore[arg-type]
     )
@@ -79,66 +110,173 @@ def parse_flag_payload(payload: bytes) -> list[bytes]:
     return [tok for tok in TOKENS_RE.findall(payload) if tok not in (b'(', b')')]
 
 
+def changedsince(modseq: int, vanished: bool = False) -> bytes:
+    return b'(CHANGEDSINCE %d%s)' % (modseq, b' VANISHED' if vanished else b'')
+
+
 def quote(value: bytes) -> bytes:
     return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
 
 
+class ImapReader(Reader):
+    """Reader copying every returned value once
+
+    Base Reader slices its bytearray (a copy) and converts the slice to bytes
+    (another copy). Here values are taken through a memoryview and consumed
+    data is dropped in place without reallocating the buffer.
+    """
+
+    def truncate(self) -> None:
+        offset = self.pos
+        del self.buf[:offset]
+        self.pos = 0
+        self._event_start -= offset
+
+    def _take(self, start: int, end: int) -> bytes:
+        with memoryview(self.buf) as view:
+            return bytes(view[start:end])
+
+    def read(self, size: int) -> ReaderCoro[bytes]:
+        if self.pos > self._truncate_size:
+            self.truncate()
+
+        pos = self.pos
+        buf = self.buf
+
+        wpos = pos + size
+        while len(buf) < wpos:
+            data = yield
+            if not data:
+                self.handle_eof()
+            buf.extend(data)
+
+        self.pos = wpos
+        return self._take(pos, wpos)
+
+    def read_until(
+        self, separator: bytes, include: bool = False, allow_partial: bool = False
+    ) -> ReaderCoro[bytes]:
+        if self.pos > self._truncate_size:
+            self.truncate()
+
+        pos = self.pos
+        buf = self.buf
+
+        start = pos
+        while (idx := buf.find(separator, start)) < 0:
+            start = max(len(buf) - len(separator) + 1, 0)
+            data = yield
+            if not data:
+                rest = self.handle_eof(allow_partial)
+                self.pos = len(buf)
+                return bytes(rest) + separator if include else bytes(rest)
+            buf.extend(data)
+
+        self.pos = idx + len(separator)
+        return self._take(pos, self.pos if include else idx)
+
+    def read_into(self, size: int, sink: LiteralSink) -> ReaderCoro[None]:
+        """Passes `size` bytes to sink as they arrive, buffering one chunk at most"""
+        buf = self.buf
+        while size:
+            if self.pos >= len(buf):
+                self.truncate()
+                data = yield
+                if not data:
+                    self.handle_eof()
+                buf.extend(data)
+
+            end = min(self.pos + size, len(buf))
+            sink.write(self._take(self.pos, end))
+            size -= end - self.pos
+            self.pos = end
+        sink.close()
+
+
+def split_tokens(line: bytes) -> list[bytes]:
+    """Splits a line into atoms, parens and quoted strings"""
+    if 34 in line:
+        # quoted strings may contain spaces and parens
+        return TOKENS_RE.findall(line)
+    return line.replace(b'(', b' ( ').replace(b')', b' ) ').split()
+
+
 @receiver
-def proto(emit: Emitter[list[Value]]) -> Parser:
-    reader = Reader()
+def proto(emit: Emitter[list[Value]], spool: Spool | None = None) -> Parser:
+    # Tokens are split by C-level bytes methods and consumed in one pass:
+    # nesting, quoted strings, sections and a trailing literal are handled
+    # as they come. Byte values are compared as ints, it's much cheaper than
+    # bytes membership tests in a per-token loop.
+    reader = ImapReader()
     while True:
-        lines = [(yield from reader.read_until(b'\r\n'))]
+        lines = deque([(yield from reader.read_until(b'\r\n'))])
         # print('PROTO:', lines)
         result: list[Value] = []
         stack = [result]
-        lnum = 0
+        append = result.append
+        first = True
         while lines:
-            lnum += 1
-            line = lines.pop(0)
+            line = lines.popleft()
             if not line:
                 break
 
-            if lnum == 1 and line.startswith(b'+'):
-                result = line.split(None, 1)  # type: ignore[assignment]
-                break
-
-            tokens: list[bytes] = TOKENS_RE.findall(line)
-            if lnum == 1 and len(tokens) >= 2 and tokens[1].upper() in RESP_TEXT:
-                code, text = parse_resp_text(line.split(None, 2)[2] if len(tokens) > 2 else b'')
-                result = [tokens[0], tokens[1], code, text]  # type: ignore[list-item]
-                break
-
-            if b'[' in line:
-                ptokens = []
-                itokens = iter(tokens)
-                for tok in itokens:
-                    if not tok.startswith(b'"') and b'[' in tok and b']' not in tok:
-                        jtok = [tok]
-                        for it in itokens:
-                            jtok.append(it)
-                            if b']' in it:
-                                break
-                        tok = b' '.join(jtok)
-                    ptokens.append(tok)
-            else:
-                ptokens = tokens
-
-            for idx, tok in enumerate(ptokens, 1):
-                if tok.startswith(b'{') and idx == len(ptokens):
-                    size = int(tok[1:-1])
-                    tok = yield from reader.read(size)
-                    lines.append((yield from reader.read_until(b'\r\n')))
-                elif tok.startswith(b'"'):
-                    tok = tok[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\')
-                elif tok == b'(':
+            if first:
+                first = False
+                if line[0] == 43:  # +
+                    result = line.split(None, 1)  # type: ignore[assignment]
+                    break
+
+                parts = line.split(None, 2)
+                if len(parts) >= 2 and parts[1].upper() in RESP_TEXT:
+                    code, text = parse_resp_text(parts[2] if len(parts) > 2 else b'')
+                    result = [parts[0], parts[1], code, text]  # type: ignore[list-item]
+                    break
+
+            tokens = split_tokens(line)
+            literal = tokens.pop() if tokens and tokens[-1][0] == 123 else None  # {
+
+            itokens = iter(tokens)
+            for tok in itokens:
+                c = tok[0]
+                if c == 40:  # (
                     group: list[Value] = []
-                    add_value(stack, group)
+                    append(group)
                     stack.append(group)
-                    continue
-                elif tok == b')':
+                    append = group.append
+                elif c == 41:  # )
                     stack.pop()
-                    continue
-                add_value(stack, tok)
+                    append = stack[-1].append
+                elif c == 34:  # "
+                    tok = tok[1:-1]
+                    if 92 in tok:
+                        tok = tok.replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+                    append(tok)
+                elif 91 in tok and 93 not in tok:
+                    # section with spaces, BODY[HEADER.FIELDS (DATE)] is
+                    # kept as a single token: BODY[HEADER.FIELDS ( DATE ) ]
+                    jtok = [tok]
+                    for it in itokens:
+                        jtok.append(it)
+                        if 93 in it:
+                            break
+                    else:
+                        if literal is not None:
+                            jtok.append(literal)
+                            literal = None
+                    append(b' '.join(jtok))
+                else:
+                    append(tok)
+
+            if literal is not None:
+                size = int(literal[1:-1])
+                sink = spool(size) if spool is not None else None
+                if sink is None:
+                    append((yield from reader.read(size)))
+                else:
+                    yield from reader.read_into(size, sink)
+                    # spooled literal is represented by its sink
+                    append(sink)  # type: ignore[arg-type]
+                lines.append((yield from reader.read_until(b'\r\n')))
 
         # print('EMIT:', result)
         emit(result)
@@ -147,43 +285,91 @@ def proto(emit: Emitter[list[Value]]) -> Parser:
 class Proto:
     def __init__(self) -> None:
         self._counter = 0
-        self._lines: list[list[Value]] = []
-        self._lpos = 0
-        self._receiver = proto(self._lines.append)
+        self._untagged: list[list[Value]] = []
+        self._done: dict[bytes, Response] = {}
+        # sent commands not completed yet
+        self._inflight: set[bytes] = set()
+        self._bye: Status | None = None
+        self._receiver = proto(self._dispatch, self._spool)
         self._current_tag = b''
         self.send = self._receiver.send
+        self.spool: Spool | None = None
+
+    def _spool(self, size: int) -> LiteralSink | None:
+        return self.spool(size) if self.spool is not None else None
 
     def _tag(self) -> bytes:
         tag = self._current_tag = f'A{self._counter}'.encode()
         self._counter += 1
         return tag
 
-    def wait_response(
-        self, data: bytes, tag: bytes | None = None, status: bool = True
-    ) -> Response | None:
+    def _dispatch(self, line: list[Value]) -> None:
+        # Untagged data is attributed to the next completed tag, so every
+        # line is routed once on arrival and never rescanned.
+        tag: bytes = line[0]  # type: ignore[assignment]
+        if tag == b'+':
+            status = parse_status(line)
+        elif len(line) >= 2 and line[1].upper() in RESP_TEXT:  # type: ignore[union-attr]
+            status = parse_status(line)
+            if tag == b'*':
+                if status.kind.upper() == b'BYE':
+                    self._bye = status
+                # A status line before any command is the server greeting
+                if self._current_tag:
+                    self._untagged.append(line)
+                    return
+        else:
+            self._untagged.append(line)
+            return
+
+        self._inflight.discard(tag)
+        self._done[tag] = Response(self._untagged, status)
+        self._untagged = []
+
+    def pop_response(self, tag: bytes) -> Response | None:
+        if self._bye is not None:
+            raise ValueError(self._bye.text)
+
+        current = self._done.get(self._current_tag)
+        if current is not None and current.status.kind.upper() in BAD_RESP_TEXT:
+            del self._done[self._current_tag]
+            raise ValueError(current.status.text)
+
+        resp = self._done.pop(tag, None)
+        if resp is not None and resp.status.kind.upper() in BAD_RESP_TEXT:
+            raise ValueError(resp.status.text)
+        return resp
+
+    def pending(self, tag: bytes) -> bool:
+        """Tells if the response of tag is still to be received or taken"""
+        return self._bye is None and (tag in self._inflight or tag in self._done)
+
+    def wait_response(self, data: Chunk, tag: bytes | None = None) -> Response | None:
         tag = tag or self._current_tag
         self.send(data)
-        # print('##: ', self._lines)
-        idx = self._lpos
-        for idx in range(self._lpos, len(self._lines)):
-            line = self._lines[idx]
-            if len(line) >= 2 and line[1].upper() in BAD_RESP_TEXT:  # type: ignore[union-attr]
-                line_status = parse_status(line)
-                if line_status.tag == self._current_tag or line_status.kind.upper() == b'BYE':
-                    raise ValueError(line_status.text)
-
-            if line[0] == tag and (not status or (len(line) >= 2 and line[1].upper() in RESP_TEXT)):  # type: ignore[union-attr]
-                result = self._lines[:idx]
-                resp = self._lines[idx]
-                self._lines[:] = self._lines[idx + 1 :]
-                self._lpos = 0
-                return Response(result, parse_status(resp))
-
-        self._lpos = idx
-        return None
+        return self.pop_response(tag)
+
+    def stream_response(
+        self, data: Chunk, tag: bytes | None = None
+    ) -> tuple[list[list[Value]], Status | None]:
+        """Returns untagged lines parsed so far and completion status if any
+
+        Unlike wait_response it does not buffer untagged data until completion,
+        so a caller can process it while the rest of the response is in flight.
+        """
+        self.send(data)
+        return self.take_response(tag or self._current_tag)
+
+    def take_response(self, tag: bytes) -> tuple[list[list[Value]], Status | None]:
+        resp = self.pop_response(tag)
+        if resp is None:
+            lines, self._untagged = self._untagged, []
+            return lines, None
+        return resp.data, resp.status
 
     def command(self, cmd: str, data: Collection[bytes]) -> bytes:
         tag = self._current_tag = self._tag()
+        self._inflight.add(tag)
         payload = b' '.join((tag, cmd.encode(), *data)) + b'\r\n'
         return payload
 
@@ -193,7 +379,8 @@ class Proto:
         result = []
         ccmd = cmd.encode().upper()
         for it in response:
-            if len(it) > cmd_idx and it[cmd_idx].upper() == ccmd:  # type: ignore[union-attr]
+            name = it[cmd_idx] if len(it) > cmd_idx else None
+            if isinstance(name, bytes) and name.upper() == ccmd:
                 result.append(it[cmd_idx + 1 :])
         return result
 
@@ -207,20 +394,70 @@ class Proto:
         result: list[int] = []
         for it in self.collect_result('SEARCH', response.data):
             result.extend(int(uid) for uid in it)  # type: ignore[arg-type]
+        for esearch in self.collect_esearch(response):
+            result.extend(esearch.uids())
         return result
 
-    def collect_pairs(
-        self, cmd: str, response: Response, cmd_idx: int = 1
-    ) -> list[dict[str, Value]]:
-        result: list[dict[str, Value]] = []
-        for it in self.collect_result(cmd, response.data, cmd_idx=cmd_idx):
-            result.append(item := {})
+    def collect_esearch(self, response: Response) -> list[ESearch]:
+        """Parses ESEARCH (RFC 4731) responses
+
+        * ESEARCH (TAG "A1") UID MIN 2 MAX 47 COUNT 5 ALL 2,10:47
+        """
+        result: list[ESearch] = []
+        for it in self.collect_result('ESEARCH', response.data):
+            result.append(esearch := ESearch())
+            items = iter(it)
+            for name in items:
+                if isinstance(name, list):
+                    continue  # search correlator
+
+                name = name.upper()
+                if name == b'UID':
+                    esearch.uid = True
+                    continue
+
+                value: bytes = next(items)  # type: ignore[assignment]
+                if name == b'MIN':
+                    esearch.min = int(value)
+                elif name == b'MAX':
+                    esearch.max = int(value)
+                elif name == b'COUNT':
+                    esearch.count = int(value)
+                elif name == b'ALL':
+                    esearch.all = value
+        return result
+
+    def iter_pairs(
+        self, cmd: str, lines: list[list[Value]], cmd_idx: int = 1
+    ) -> Iterator[dict[str, Value]]:
+        for it in self.collect_result(cmd, lines, cmd_idx=cmd_idx):
+            item: dict[str, Value] = {}
             k: bytes
-            for k, v in zip(it[0][::2], it[0][1::2], strict=True):  #type: ignore[assignment]
+            v: Value
+            for k, v in zip(it[0][::2], it[0][1::2], strict=True):  # type: ignore[assignment]
                 key = k.upper().decode()
                 item[key] = v
                 if cmd == 'FETCH' and key.startswith(('BODY[', 'BODY.')):
                     item['BODY'] = v
+            yield item
+
+    def collect_pairs(
+        self, cmd: str, response: Response, cmd_idx: int = 1
+    ) -> list[dict[str, Value]]:
+        return list(self.iter_pairs(cmd, response.data, cmd_idx=cmd_idx))
+
+    def collect_vanished(self, response: Response) -> list[int]:
+        result: list[int] = []
+        for it in self.collect_result('VANISHED', response.data):
+            result.extend(seqset.decode(it[-1]))  # type: ignore[arg-type]
+        return result
+
+    def collect_status(self, response: Response) -> dict[str, int]:
+        result: dict[str, int] = {}
+        for it in self.collect_result('STATUS', response.data):
+            items: list[bytes] = it[-1]  # type: ignore[assignment]
+            for k, v in zip(items[::2], items[1::2]):
+                result[k.upper().decode()] = int(v)
         return result
 
     def collect_select(self, response: Response) -> Select:
@@ -284,35 +521,110 @@ class Proto:
         )
 
 
-class Client:
+class ClientBase:
+    """Transport independent part of Client and AsyncClient"""
+
+    def __init__(self) -> None:
+        self._proto = Proto()
+        self._capabilities: set[bytes] | None = None
+        self._deflate: zlib._Compress | None = None
+        self._inflate: zlib._Decompress | None = None
+
+        # payload vs on-the-wire byte counters, differ with COMPRESS
+        self.received = 0
+        self.sent = 0
+        self.wire_received = 0
+        self.wire_sent = 0
+
+    def _decode_received(self, data: Chunk) -> Chunk | None:
+        """Returns payload of received wire data, None for a partial deflate block"""
+        self.wire_received += len(data)
+        if data and self._inflate is not None:
+            data = self._inflate.decompress(data)
+            if not data:
+                # empty result would mean EOF for the parser
+                return None
+        self.received += len(data)
+        return data
+
+    def _encode_sent(self, data: bytes) -> bytes:
+        self.sent += len(data)
+        if self._deflate is not None:
+            data = self._deflate.compress(data) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_sent += len(data)
+        return data
+
+    def _start_compression(self) -> None:
+        self._deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self._inflate = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+    def _set_capabilities(self, resp: Response) -> set[bytes]:
+        self._capabilities = {
+            cap.upper()  # type: ignore[union-attr]
+            for it in self._proto.collect_result('CAPABILITY', resp.data)
+            for cap in it
+        }
+        return self._capabilities
+
+
+class Client(ClientBase):
     def __init__(self, sock: socket.socket):
+        super().__init__()
         self._sock = sock
-        self._proto = Proto()
-
+        # received data is only valid until the next _recv call
+        self._buf = bytearray(BUFSIZE)
+        self._view = memoryview(self._buf)
         self._init()
 
     def _init(self) -> None:
         self._wait_response(b'*')
 
-    def _wait_response(self, tag: bytes | None = None, status: bool = True) -> Response:
+    def _recv(self) -> Chunk:
         while True:
-            resp = self._proto.wait_response(self._sock.recv(BUFSIZE), tag, status)
-            if resp:
-                return resp
+            size = self._sock.recv_into(self._buf)
+            if (data := self._decode_received(self._view[:size])) is not None:
+                return data
 
-    def _send_command(self, cmd: str, data: Collection[bytes] = ()) -> None:
-        self._sock.sendall(self._proto.command(cmd, data))
+    def _sendall(self, data: bytes) -> None:
+        self._sock.sendall(self._encode_sent(data))
+
+    def _wait_response(self, tag: bytes | None = None) -> Response:
+        tag = tag or self._proto._current_tag
+        resp = self._proto.pop_response(tag)
+        while resp is None:
+            resp = self._proto.wait_response(self._recv(), tag)
+        return resp
+
+    def _send_command(self, cmd: str, data: Collection[bytes] = ()) -> bytes:
+        self._sendall(self._proto.command(cmd, data))
+        return self._proto._current_tag
 
     def authenticate(self, mechanism: str, data: bytes) -> None:
         self._send_command('AUTHENTICATE', (mechanism.encode(),))
-        resp = self._wait_response(b'+', status=False)
-        # print('@@ cont', resp)
-        self._sock.sendall(base64.b64encode(data) + b'\r\n')
-        resp = self._wait_response()
-        # print('@@ auth resp', resp)
+        self._wait_response(b'+')
+        self._sendall(base64.b64encode(data) + b'\r\n')
+        self._wait_response()
+        self._capabilities = None
 
     def login(self, username: bytes, password: bytes) -> None:
         self.command('LOGIN', (quote(username), quote(password)))
+        self._capabilities = None
+
+    def capabilities(self) -> set[bytes]:
+        if self._capabilities is None:
+            return self._set_capabilities(self.command('CAPABILITY'))
+        return self._capabilities
+
+    def has_capability(self, name: bytes) -> bool:
+        return name.upper() in self.capabilities()
+
+    def enable(self, *capabilities: bytes) -> None:
+        self.command('ENABLE', capabilities)
+
+    def compress(self) -> None:
+        """Turns on COMPRESS=DEFLATE (RFC 4978) for the rest of the session"""
+        self.command('COMPRESS', (b'DEFLATE',))
+        self._start_compression()
 
     def command(self, cmd: str, data: Collection[bytes] = (), uid: bool = False) -> Response:
         if uid:
@@ -321,16 +633,148 @@ class Client:
         self._send_command(cmd, data)
         return self._wait_response()
 
+    def queue(self, cmd: str, data: Collection[bytes] = (), uid: bool = False) -> bytes:
+        """Sends a command without waiting for completion and returns its tag
+
+        Responses are matched back by tag with :meth:`result`. Untagged data is
+        attributed to the command completed right after it.
+        """
+        if uid:
+            cmd = 'UID ' + cmd
+        return self._send_command(cmd, data)
+
+    def result(self, tag: bytes) -> Response:
+        return self._wait_response(tag)
+
+    def pipeline(self, commands: Iterable[tuple[str, Collection[bytes]]]) -> list[Response]:
+        """Sends commands at once and returns their responses
+
+        If a command fails the rest are waited for before raising, so their
+        responses do not end up in later ones.
+        """
+        tags = [self.queue(cmd, data) for cmd, data in commands]
+        result: list[Response] = []
+        try:
+            for tag in tags:
+                result.append(self.result(tag))
+        except ValueError:
+            self._discard(tags[len(result) :])
+            raise
+        return result
+
+    def _discard(self, tags: Iterable[bytes]) -> None:
+        for tag in tags:
+            while self._proto.pending(tag):
+                try:
+                    self._wait_response(tag)
+                except ValueError:
+                    pass
+
     def select(self, mailbox: bytes) -> Select:
         return self._proto.collect_select(self.command('SELECT', (quote(mailbox),)))
 
-    def search(self, criteria: bytes, uid: bool = False) -> list[int]:
+    def search(self, criteria: bytes, uid: bool = False, esearch: bool = False) -> list[int]:
+        """SEARCH, with esearch set results come as a compact ESEARCH sequence set"""
+        if esearch:
+            criteria = b'RETURN (ALL) ' + criteria
         return self._proto.collect_search(self.command('SEARCH', (criteria,), uid=uid))
 
+    def status(self, mailboxes: Iterable[bytes], items: bytes) -> list[dict[str, int]]:
+        """Pipelined STATUS for several mailboxes, one round trip for all of them"""
+        responses = self.pipeline(('STATUS', (quote(it), items)) for it in mailboxes)
+        return [self._proto.collect_status(it) for it in responses]
+
+    def esearch(
+        self,
+        criteria: bytes,
+        uid: bool = False,
+        returns: bytes = b'(ALL MIN MAX COUNT)',
+    ) -> ESearch:
+        resp = self.command('SEARCH', (b'RETURN', returns, criteria), uid=uid)
+        result = self._proto.collect_esearch(resp)
+        # empty result may come without ESEARCH response at all
+        return result[0] if result else ESearch(uid=uid, count=0)
+
+    def select_search(
+        self, mailbox: bytes, criteria: bytes, uid: bool = False, esearch: bool = False
+    ) -> tuple[Select, list[int]]:
+        if esearch:
+            criteria = b'RETURN (ALL) ' + criteria
+        select_resp, search_resp = self.pipeline(
+            [
+                ('SELECT', (quote(mailbox),)),
+                ('UID SEARCH' if uid else 'SEARCH', (criteria,)),
+            ]
+        )
+        return (
+            self._proto.collect_select(select_resp),
+            self._proto.collect_search(search_resp),
+        )
+
     def fetch(self, query: bytes, fields: bytes, uid: bool = False) -> list[dict[str, Value]]:
         resp = self.command('FETCH', (query, fields), uid=uid)
         return self._proto.collect_pairs('FETCH', resp, cmd_idx=2)
 
+    def fetch_iter(
+        self, query: bytes, fields: bytes, uid: bool = False
+    ) -> Iterator[dict[str, Value]]:
+        """Yields FETCH items as soon as they are parsed
+
+        The connection is busy until the iterator is exhausted. An abandoned
+        iterator drains the rest of the response on close.
+        """
+        return self.fetch_many((query,), fields, uid=uid, depth=1)
+
+    def fetch_many(
+        self,
+        queries: Iterable[bytes],
+        fields: bytes,
+        uid: bool = False,
+        depth: int = PIPELINE_DEPTH,
+        spool: Spool | None = None,
+    ) -> Iterator[dict[str, Value]]:
+        """Like fetch_iter but keeps up to `depth` FETCH commands in flight
+
+        Literals accepted by `spool` are streamed into sinks it returns and
+        come as sink objects in place of bytes.
+        """
+        queries = iter(queries)
+        inflight: deque[bytes] = deque()
+        self._proto.spool = spool
+        try:
+            while True:
+                while len(inflight) < depth and (query := next(queries, None)) is not None:
+                    inflight.append(self.queue('FETCH', (query, fields), uid=uid))
+
+                if not inflight:
+                    return
+
+                self._proto.send(self._recv())
+                while inflight:
+                    lines, status = self._proto.take_response(inflight[0])
+                    yield from self._proto.iter_pairs('FETCH', lines, cmd_idx=2)
+                    if status is None:
+                        break
+                    inflight.popleft()
+        except (GeneratorExit, ValueError):
+            # responses of the rest would end up in later commands
+            self._discard(inflight)
+            raise
+        finally:
+            self._proto.spool = None
+
+    def fetch_changed(
+        self, query: bytes, fields: bytes, modseq: int, vanished: bool = False
+    ) -> tuple[list[dict[str, Value]], list[int]]:
+        """UID FETCH of messages changed since modseq (RFC 7162)
+
+        Returns FETCH items and, with QRESYNC enabled and vanished set,
+        UIDs expunged since modseq.
+        """
+        resp = self.command('FETCH', (query, fields, changedsince(modseq, vanished)), uid=True)
+        items = self._proto.collect_pairs('FETCH', resp, cmd_idx=2)
+        return items, self._proto.collect_vanished(resp)
+
     def store(
         self, query: bytes, modifier: bytes, flags: bytes, uid: bool = False
     ) -> list[dict[str, Value]]:
@@ -343,10 +787,45 @@ class Client:
         resp = self.command('LIST', (directory, pattern))
         return self._proto.collect_list(resp)
 
+    def idle(self, timeout: float = IDLE_TIMEOUT, wakeup: int | None = None) -> list[list[Value]]:
+        """Waits in IDLE until the server sends untagged data or timeout expires
+
+        Returns untagged lines received while idling. Idling also stops when
+        the `wakeup` file descriptor becomes readable.
+        """
+        tag = self.queue('IDLE')
+        result = self._wait_response(b'+').data
+
+        deadline = time.monotonic() + timeout
+        sock_timeout = self._sock.gettimeout()
+        try:
+            while not result and (remaining := deadline - time.monotonic()) > 0:
+                # SSL sockets may hold decrypted data select does not know about
+                pending = getattr(self._sock, 'pending', None)
+                if wakeup is not None and not (pending and pending()):
+                    ready, _, _ = select.select([self._sock.fileno(), wakeup], [], [], remaining)
+                    if not ready or wakeup in ready:
+                        break
+                self._sock.settimeout(remaining)
+                try:
+                    data = self._recv()
+                except TimeoutError:
+                    break
+                result, _ = self._proto.stream_response(data, tag)
+        finally:
+            self._sock.settimeout(sock_timeout)
+
+        self._sendall(b'DONE\r\n')
+        return result + self._wait_response(tag).data
+
+    def close(self) -> None:
+        self._sock.close()
+
 
 if __name__ == '__main__':
-    import sys
     import ssl
+    import sys
+
     from norless import config
 
     cfg = config.NorlessConfig(sys.argv[1])
@@ -361,7 +840,7 @@ if __name__ == '__main__':
     print(c.command('CAPABILITY').data[-1])
 
     assert acc.xoauth2
-    xo = 'user={}\x01auth=Bearer {}\x01\x01'.format(acc.username, acc.xoauth2.get_token()).encode()
+    xo = f'user={acc.username}\x01auth=Bearer {acc.xoauth2.get_token()}\x01\x01'.encode()
     c.authenticate('XOAUTH2', xo)
 
     for it in c.list_folders():
@@ -0,0 +1,157 @@
+"""Linux inotify over ctypes and a watcher keeping Maildir.toc up to date
+
+Lets a long-running process notice what other programs (MUAs) do in new/
+and cur/ without listing the directories again.
+"""
+
+import ctypes
+import os
+import struct
+from typing import NamedTuple
+
+from .maildir import Maildir, parse_info
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+MAILDIR_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+
+class Event(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+def parse_events(data: bytes) -> list[Event]:
+    result = []
+    pos = 0
+    while pos < len(data):
+        wd, mask, cookie, size = EVENT.unpack_from(data, pos)
+        pos += EVENT.size
+        name = data[pos : pos + size].rstrip(b'\0')
+        pos += size
+        result.append(Event(wd, mask, cookie, os.fsdecode(name)))
+    return result
+
+
+class Inotify:
+    """Non-blocking inotify instance, raises OSError where unsupported"""
+
+    def __init__(self) -> None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError('inotify is not available') from e
+
+        self._add_watch.argtypes = ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+        self.fd: int = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return int(wd)
+
+    def read(self) -> list[Event]:
+        """Returns pending events, an empty list if there are none"""
+        try:
+            return parse_events(os.read(self.fd, READ_SIZE))
+        except BlockingIOError:
+            return []
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Change(NamedTuple):
+    maildir: Maildir
+    # added, removed, flags or rescan
+    kind: str
+    msgkey: str
+
+
+class MaildirWatcher:
+    """Applies creates, renames and deletes in new/ and cur/ to Maildir.toc
+
+    Changes made through Maildir itself are already in the toc and are not
+    reported. An overflowed event queue drops all tocs and reports rescan.
+    """
+
+    def __init__(self, maildirs: list[Maildir]) -> None:
+        self.inotify = Inotify()
+        self.maildirs = maildirs
+        self._dirs: dict[int, tuple[Maildir, str]] = {}
+        for maildir in maildirs:
+            for path in (maildir.path_new, maildir.path_cur):
+                self._dirs[self.inotify.add_watch(path, MAILDIR_EVENTS)] = maildir, path
+            # loaded after watches are set up, no change can slip in between
+            _ = maildir.toc
+
+    def fileno(self) -> int:
+        return self.inotify.fileno()
+
+    def close(self) -> None:
+        self.inotify.close()
+
+    def read(self) -> list[Change]:
+        """Applies pending events and returns changes made by other programs"""
+        changes = []
+        # renames come as MOVED_FROM and MOVED_TO with the same cookie
+        moved: dict[int, tuple[Maildir, str, tuple[str, str]]] = {}
+        for event in self.inotify.read():
+            if event.mask & IN_Q_OVERFLOW:
+                for maildir in self.maildirs:
+                    maildir._invalidate()
+                    changes.append(Change(maildir, 'rescan', ''))
+                continue
+
+            if event.mask & (IN_IGNORED | IN_ISDIR) or event.wd not in self._dirs:
+                continue
+
+            maildir, dirpath = self._dirs[event.wd]
+            path = os.path.join(dirpath, event.name)
+            msgkey, _, info = event.name.partition(':')
+            if event.mask & (IN_CREATE | IN_MOVED_TO):
+                if not os.path.exists(path):
+                    continue  # moved again, a later event tells where
+                old = maildir.update_entry(msgkey, path, info)
+                if source := moved.pop(event.cookie, None):
+                    if source[0] is maildir and source[1] == msgkey:
+                        old = source[2]
+                    else:
+                        changes.append(Change(source[0], 'removed', source[1]))
+
+                if old is None:
+                    changes.append(Change(maildir, 'added', msgkey))
+                elif parse_info(old[1]) != parse_info(info):
+                    changes.append(Change(maildir, 'flags', msgkey))
+            elif (old := maildir.remove_entry(msgkey, path)) is not None:
+                if event.mask & IN_MOVED_FROM:
+                    moved[event.cookie] = maildir, msgkey, old
+                else:
+                    changes.append(Change(maildir, 'removed', msgkey))
+
+        changes.extend(Change(maildir, 'removed', msgkey) for maildir, msgkey, _ in moved.values())
+        return changes
@@ -1,18 +1,174 @@
-import os
+import ctypes
 import errno
+import gzip
+import lzma
+import marshal
+import os
+import re
 import socket
-
-from time import time
-from threading import RLock, local
-from tempfile import mkstemp
-from os.path import join, exists, isfile, basename
+import zlib
+from collections.abc import Iterator
+from email.parser import BytesHeaderParser
 from hashlib import sha256
-
+from io import BufferedIOBase
+from itertools import count
 from mailbox import Message as _Message
-from typing import Dict, Iterator, Tuple
+from os.path import basename, dirname, exists, join
+from tempfile import mkstemp
+from threading import Lock, RLock, local
+from time import time, time_ns
+from typing import Protocol
 
 from .state import SqliteState
 
+# spooled messages keep this much of their beginning to parse headers
+HEAD_SIZE = 64 * 1024
+
+# none: rely on the OS to write messages out eventually
+# per-message: fsync every message file and its directory when it's added
+# group: fsync messages added since the last state commit, then new/ and
+#   cur/, right before the commit
+# syncfs: group with one syncfs(2) instead, it also flushes writes of other
+#   programs to the same filesystem
+FSYNC_MODES = 'none', 'per-message', 'group', 'syncfs'
+
+# compressed messages are gzip or xz files, the message key ends with the
+# suffix so a maildir may hold files of any mode
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'xz': '.xz'}
+
+# new/ and cur/ listings are kept here along with the directory mtimes
+TOC_SNAPSHOT = 'toc.snapshot'
+# a listing is trusted only if the directory was modified earlier than
+# this many nanoseconds before the scan, a change within the same mtime
+# tick would go unnoticed otherwise
+RACY_MTIME = 2 * 10**9
+
+NEWLINE_RE = re.compile(rb'\r\n|\r|\n')
+# same as email.feedparser.headerRE
+HEADER_RE = re.compile(rb'From |[\041-\071\073-\176]*:|[\t ]')
+
+
+def message_hash(data: bytes) -> str:
+    return sha256(data).hexdigest()
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+def make_compressor(compression: str) -> Compressor | None:
+    if compression == 'gzip':
+        return zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == 'xz':
+        return lzma.LZMACompressor()
+    return None
+
+
+def key_compression(key: str) -> str:
+    for compression, suffix in COMPRESSIONS.items():
+        if suffix and key.endswith(suffix):
+            return compression
+    return 'none'
+
+
+def fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path: str) -> bool:
+    """Flushes the filesystem holding path, returns False without syncfs(2)"""
+    try:
+        func = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return False
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if func(fd) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+    return True
+
+
+class Headers:
+    """Top-level message headers parsed without building a MIME tree
+
+    Scanning stops at the first line which is not a header. Values are the
+    same as `email` (compat32 policy) returns for an ASCII header block,
+    other blocks are handed to the email header parser.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self._headers: dict[str, str] = {}
+        self.size = header_size(data)
+
+        head = data[: self.size]
+        if not head.isascii():
+            for key, item in BytesHeaderParser().parsebytes(head).items():
+                self._headers.setdefault(key.lower(), str(item))
+            return
+
+        name = ''
+        value: list[bytes] = []
+        for line in iter_lines(head):
+            if line[:1] in (b' ', b'\t'):
+                if name:
+                    value.append(line)
+                continue
+
+            self._add(name, value)
+            name = ''
+            idx = line.find(b':')
+            if line.startswith(b'From ') or idx <= 0:
+                continue  # unix from line or a malformed header
+
+            name = line[:idx].decode().lower()
+            value = [line[idx + 1 :].lstrip(b' \t')]
+        self._add(name, value)
+
+    def _add(self, name: str, value: list[bytes]) -> None:
+        if name and name not in self._headers:
+            self._headers[name] = b''.join(value).rstrip(b'\r\n').decode()
+
+    def get(self, name: str, default: str | None = None) -> str | None:
+        return self._headers.get(name.lower(), default)
+
+    def __getitem__(self, name: str) -> str | None:
+        return self._headers.get(name.lower())
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._headers
+
+
+def iter_lines(data: bytes) -> Iterator[bytes]:
+    """Yields lines with line endings, like email.feedparser splits them"""
+    pos = 0
+    while pos < len(data):
+        m = NEWLINE_RE.search(data, pos)
+        end = m.end() if m else len(data)
+        yield data[pos:end]
+        pos = end
+
+
+def header_size(data: bytes) -> int:
+    """Returns the length of the header block including the blank line"""
+    pos = 0
+    for line in iter_lines(data):
+        if not HEADER_RE.match(line):
+            if NEWLINE_RE.fullmatch(line):
+                pos += len(line)
+            break
+        pos += len(line)
+    return pos
+
 
 class Message(_Message):
     msgkey: str
@@ -28,7 +184,68 @@ class Message(_Message):
             self.size = len(data)
 
     def hash(self) -> str:
-        return sha256(self.original_body).hexdigest()
+        return message_hash(self.original_body)
+
+
+class TmpMessage:
+    """Message written into maildir tmp/ chunk by chunk
+
+    Only the head of the message is kept in memory to parse headers, the
+    SHA-256 of the whole message is computed along the way. Headers, hash
+    and size are of the original message also if it is stored compressed.
+    """
+
+    def __init__(
+        self, fd: int, path: str, fsync: bool = False, compressor: Compressor | None = None
+    ) -> None:
+        self.fd: int | None = fd
+        self.path = path
+        self.fsync = fsync
+        self.size = 0
+        self._sha = sha256()
+        self._head = bytearray()
+        self._compressor = compressor
+
+    def write(self, data: bytes) -> None:
+        if len(self._head) < HEAD_SIZE:
+            self._head += data[: HEAD_SIZE - len(self._head)]
+        self._sha.update(data)
+        self.size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data: bytes) -> None:
+        assert self.fd is not None
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+
+    def close(self) -> None:
+        if self.fd is not None:
+            if self._compressor is not None:
+                self._write(self._compressor.flush())
+            if self.fsync:
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def hash(self) -> str:
+        return self._sha.hexdigest()
+
+    def headers(self) -> Headers:
+        return Headers(bytes(self._head))
+
+
+def scan_dir(path: str) -> dict[str, tuple[str, str]]:
+    """Returns toc entries of message files in a new/ or cur/ directory"""
+    result = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                msgkey, _, info = entry.name.partition(':')
+                result[msgkey] = entry.path, info
+    return result
 
 
 def parse_info(info: str) -> str:
@@ -39,23 +256,54 @@ def parse_info(info: str) -> str:
     return ''
 
 
-class Maildir(object):
+class Maildir:
+    """Maildir with a toc of message keys and an SqliteState per thread
+
+    `fsync` is one of FSYNC_MODES. In group and syncfs modes messages are
+    made durable before state rows referring to them are committed.
+
+    The lock guards the toc only, messages are written, linked and renamed
+    outside of it so threads sharing a maildir store messages in parallel.
+
+    `compression` is one of COMPRESSIONS, new messages are stored with it.
+    Reads return the original bytes whatever mode a message was stored in.
+    """
+
     _toc: dict[str, tuple[str, str]]
 
     def __init__(
-        self, path: str, create: bool = True, msg_mode: int = 0o600, dir_mode: int = 0o700
+        self,
+        path: str,
+        create: bool = True,
+        msg_mode: int = 0o600,
+        dir_mode: int = 0o700,
+        fsync: str = 'none',
+        compression: str = 'none',
     ) -> None:
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f'Unknown fsync mode: {fsync}')
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression: {compression}')
+
         self.path = path
         self.msg_mode = msg_mode
         self.dir_mode = dir_mode
+        self.fsync = fsync
+        self._group_fsync = fsync in ('group', 'syncfs')
+        self.compression = compression
+        # keys of messages added in group mode since the last flush
+        self._unsynced: list[str] = []
 
         self.lock = RLock()
+        # held while flushing so a concurrent flush waits for keys already taken
+        self._flush_lock = Lock()
 
         self.path_new = join(path, 'new')
         self.path_cur = join(path, 'cur')
         self.path_tmp = join(path, 'tmp')
 
-        self._counter = 0
+        # next() on itertools.count is atomic, names stay unique across threads
+        self._counter = count(1)
         self._host = socket.gethostname().replace('.', '-').replace(':', '-')
         self._pid = os.getpid()
         self._state_local = local()
@@ -75,51 +323,152 @@ class Maildir(object):
             return self._state_local.state  # type: ignore[no-any-return]
         except AttributeError:
             state = SqliteState(self.path)
+            if self._group_fsync:
+                state.before_commit = self.flush_messages
             self._state_local.state = state
             return state
 
     @property
-    def toc(self) -> Dict[str, Tuple[str, str]]:
+    def toc(self) -> dict[str, tuple[str, str]]:
         try:
             return self._toc
         except AttributeError:
             pass
 
         with self.lock:
+            # only directories modified since the snapshot are listed
+            snapshot = self._read_snapshot()
+            fresh = {}
+            changed = False
             toc = {}
             for path in (self.path_new, self.path_cur):
-                for name in os.listdir(path):
-                    fullpath = join(path, name)
-                    if isfile(fullpath):
-                        msgkey, _, info = name.partition(':')
-                        toc[msgkey] = fullpath, info
+                name = basename(path)
+                mtime = os.stat(path).st_mtime_ns
+                entries = snapshot.get(name)
+                if entries is None or entries[0] != mtime:
+                    entries = mtime, scan_dir(path)
+                    changed = True
+                if time_ns() - mtime > RACY_MTIME:
+                    fresh[name] = entries
+                toc.update(entries[1])
+
+            if changed:
+                self._write_snapshot(fresh)
 
             self._toc = toc
             return toc
 
-    def _make_tmp_file(self) -> tuple[int, str]:
+    def _read_snapshot(self) -> dict[str, tuple[int, dict[str, tuple[str, str]]]]:
+        try:
+            # marshal.load reads a file in small pieces, loads is much faster
+            with open(join(self.path, TOC_SNAPSHOT), 'rb') as f:
+                path, snapshot = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        # paths in entries are absolute
+        if path != self.path:
+            return {}
+        return snapshot  # type: ignore[no-any-return]
+
+    def _write_snapshot(self, snapshot: dict[str, tuple[int, dict[str, tuple[str, str]]]]) -> None:
+        try:
+            fd, tmp = mkstemp(prefix=TOC_SNAPSHOT, dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump((self.path, snapshot), f)
+            os.replace(tmp, join(self.path, TOC_SNAPSHOT))
+        except OSError:
+            pass  # only a cache
+
+    def _make_tmp_file(self, compression: str) -> tuple[int, str]:
         now = time()
-        self._counter += 1
-        prefix = '{}.Q{}P{}'.format(int(now), self._counter, self._pid)
-        suffix = '.{}'.format(self._host)
+        prefix = f'{int(now)}.Q{next(self._counter)}P{self._pid}'
+        suffix = f'.{self._host}{COMPRESSIONS[compression]}'
         return mkstemp(suffix, prefix, self.path_tmp)
 
     def add(self, message: bytes, flags: str = '') -> str:
-        with self.lock:
-            fd, fpath = self._make_tmp_file()
-            msgkey = basename(fpath)
+        fd, fpath = self._make_tmp_file(self.compression)
+        if compressor := make_compressor(self.compression):
+            message = compressor.compress(message) + compressor.flush()
+        os.write(fd, message)
+        if self.fsync == 'per-message':
+            os.fsync(fd)
+        os.close(fd)
+        return self._commit(fpath, flags)
+
+    def spool(self) -> TmpMessage:
+        """Starts a message in tmp/, it appears in the maildir after commit"""
+        return TmpMessage(
+            *self._make_tmp_file(self.compression),
+            fsync=self.fsync == 'per-message',
+            compressor=make_compressor(self.compression),
+        )
+
+    def commit(self, tmp: TmpMessage, flags: str = '') -> str:
+        tmp.close()
+        return self._commit(tmp.path, flags)
+
+    def abort(self, tmp: TmpMessage) -> None:
+        """Drops a spooled message, does nothing if it is already committed"""
+        tmp.close()
+        try:
+            os.unlink(tmp.path)
+        except FileNotFoundError:
+            pass
 
-            os.write(fd, message)
-            os.close(fd)
+    def link(self, key: str, flags: str = '') -> str | None:
+        """Adds a message sharing the file of message `key` via a hard link
 
-            newpath, info = self._get_path(msgkey, flags)
-            os.link(fpath, newpath)
-            os.unlink(fpath)
+        Returns the new key, None if `key` is gone or the file system does
+        not support hard links.
+        """
+        try:
+            path, _ = self.toc[key]
+        except KeyError:
+            return None
+
+        # the new key keeps the compression suffix of the shared file
+        fd, fpath = self._make_tmp_file(key_compression(key))
+        os.close(fd)
+        # the placeholder only reserves a unique name
+        os.unlink(fpath)
+        try:
+            os.link(path, fpath)
+        except OSError:
+            return None
+        return self._commit(fpath, flags)
+
+    def _commit(self, fpath: str, flags: str) -> str:
+        msgkey = basename(fpath)
+        newpath, info = self._get_path(msgkey, flags)
+        os.link(fpath, newpath)
+        os.unlink(fpath)
+        if self.fsync == 'per-message':
+            fsync_path(dirname(newpath))
 
+        with self.lock:
+            if self._group_fsync:
+                self._unsynced.append(msgkey)
             self.toc[msgkey] = newpath, info
-
         return msgkey
 
+    def flush_messages(self) -> None:
+        """Makes messages added in group or syncfs mode durable"""
+        with self._flush_lock:
+            with self.lock:
+                keys, self._unsynced = self._unsynced, []
+            if not keys or self.fsync == 'syncfs' and syncfs(self.path):
+                return
+
+            toc = self.toc
+            for key in keys:
+                if entry := toc.get(key):
+                    try:
+                        fsync_path(entry[0])
+                    except FileNotFoundError:
+                        pass  # discarded or renamed meanwhile
+            for path in (self.path_new, self.path_cur):
+                fsync_path(path)
+
     def _invalidate(self) -> None:
         with self.lock:
             try:
@@ -127,23 +476,43 @@ class Maildir(object):
             except AttributeError:
                 pass
 
+    def update_entry(self, key: str, path: str, info: str) -> tuple[str, str] | None:
+        """Sets the toc entry of a file which appeared, returns the previous entry"""
+        with self.lock:
+            toc = self.toc
+            old = toc.get(key)
+            toc[key] = path, info
+            return old
+
+    def remove_entry(self, key: str, path: str) -> tuple[str, str] | None:
+        """Drops the toc entry of a removed file unless it already points elsewhere"""
+        with self.lock:
+            toc = self.toc
+            old = toc.get(key)
+            if old is None or old[0] != path:
+                return None
+            del toc[key]
+            return old
+
     def get_flags(self, key: str) -> str:
         _, info = self.toc[key]
         return parse_info(info)
 
     def discard(self, key: str) -> None:
-        with self.lock:
-            try:
-                path, _ = self.toc[key]
-            except KeyError:
-                return
+        """Removes a message, a file shared by linked messages stays until the last one"""
+        try:
+            path, _ = self.toc[key]
+        except KeyError:
+            return
 
-            try:
-                os.remove(path)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+        # a concurrent discard of the same message may win
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
+        with self.lock:
             self.toc.pop(key, None)
 
     def _get_path(self, key: str, flags: str) -> tuple[str, str]:
@@ -163,21 +532,20 @@ class Maildir(object):
         oldpath, _ = self.toc[key]
         newpath, info = self._get_path(key, flags)
         os.rename(oldpath, newpath)
-        self.toc[key] = newpath, info
+        with self.lock:
+            self.toc[key] = newpath, info
 
     def add_flags(self, key: str, flags: str) -> None:
-        with self.lock:
-            oldflags = self.get_flags(key)
-            added = set(flags) - set(oldflags)
-            if added:
-                newflags = oldflags + ''.join(added)
-                self._set_flags(key, newflags)
+        oldflags = self.get_flags(key)
+        added = set(flags) - set(oldflags)
+        if added:
+            newflags = oldflags + ''.join(added)
+            self._set_flags(key, newflags)
 
     def set_flags(self, key: str, flags: str) -> None:
-        with self.lock:
-            oldflags = set(self.get_flags(key))
-            if set(flags) != oldflags:
-                self._set_flags(key, flags)
+        oldflags = set(self.get_flags(key))
+        if set(flags) != oldflags:
+            self._set_flags(key, flags)
 
     def iterflags(self) -> Iterator[tuple[str, str]]:
         for key, (_, info) in self.toc.items():
@@ -186,9 +554,28 @@ class Maildir(object):
     def __contains__(self, key: str) -> bool:
         return key in self.toc
 
+    def _open(self, key: str) -> BufferedIOBase:
+        path, _ = self.toc[key]
+        compression = key_compression(key)
+        if compression == 'gzip':
+            return gzip.open(path, 'rb')
+        if compression == 'xz':
+            return lzma.open(path, 'rb')
+        return open(path, 'rb')
+
+    def get_bytes(self, key: str) -> bytes:
+        with self._open(key) as f:
+            return f.read()
+
+    def get_headers(self, key: str) -> Headers:
+        """Reads only as much of a message as needed to parse its headers"""
+        with self._open(key) as f:
+            data = f.read(HEAD_SIZE)
+            while (size := header_size(data)) == len(data) and (chunk := f.read(HEAD_SIZE)):
+                data += chunk
+        return Headers(data[:size])
+
     def __getitem__(self, key: str) -> Message:
-        path, info = self.toc[key]
-        msg = Message(open(path, 'rb').read())
-        # msg.set_flags(parse_info(info))
+        msg = Message(self.get_bytes(key))
         msg.msgkey = key
         return msg
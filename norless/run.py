@@ -1,24 +1,46 @@
-import sys
-import socket
-import os.path
 import argparse
-import threading
+import asyncio
 import logging
+import os.path
+import select
+import socket
+import sys
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
 
-from collections import Counter
-
-from .maildir import Maildir, Message
 from .config import NorlessConfig, Sync
 from .config_model import MaildirConfig
-from .imap import message_id
+from .imap import Folder, ImapBox, Info, Status, message_id
+from .imap_async import AsyncFolder, AsyncImapBox
+from .imap_client import LiteralSink, Spool
+from .inotify import Change, MaildirWatcher
+from .maildir import Headers, Maildir, TmpMessage, message_hash, parse_info
+from .state import MessageInfo, SqliteState
 
 get_maildir_lock = threading.Lock()
 log = logging.getLogger('norless')
 
+IDLE_RETRY_DELAY = 30
+
+# state rows checked per maildir by the GC pass after a sync
+GC_AFTER_SYNC = 20_000
+GC_CHUNK = 1000
+# seconds between GC passes of a maildir during --idle
+IDLE_GC_INTERVAL = 3600
+
 Flags = tuple[str, ...]
 
+FLAG_MAP = {'\\Seen': 'S', '\\Answered': 'R', '\\Flagged': 'F', '\\Draft': 'D'}
+
 maildir_cache: dict[str, Maildir] = {}
 
+# monotonic time of the last GC pass by maildir path, see gc_during_idle
+last_gc: dict[str, float] = {}
+last_gc_lock = threading.Lock()
+
 
 def get_maildir(config: NorlessConfig, maildir: MaildirConfig) -> Maildir:
     with get_maildir_lock:
@@ -28,7 +50,9 @@ def get_maildir(config: NorlessConfig, maildir: MaildirConfig) -> Maildir:
         except KeyError:
             pass
 
-        result = maildir_cache[key] = Maildir(key)
+        result = maildir_cache[key] = Maildir(
+            key, fsync=maildir.fsync, compression=maildir.compression
+        )
         return result
 
 
@@ -37,33 +61,223 @@ def store_message(
     account: str,
     folder: str,
     uid: int,
-    message: bytes,
+    message: bytes | TmpMessage,
     flags: tuple[str, ...],
     *,
     seen: bool = False,
+    dedup: bool = False,
 ) -> None:
+    """Stores a fetched message and its state row
+
+    With dedup a message with the hash of one already stored in the
+    maildir, under any folder or account, becomes a hard link to its file.
+    """
     mflags = ''
     if seen or '\\Seen' in flags:
         mflags += 'S'
 
-    msg = Message(message)
-    fname = maildir.add(message, mflags)
+    if isinstance(message, TmpMessage):
+        headers = message.headers()
+        hsh = message.hash()
+    else:
+        headers = Headers(message)
+        hsh = message_hash(message)
+
+    state = maildir.state
+    fname = link_stored(maildir, state.by_hash(hsh), mflags) if dedup else None
+    if isinstance(message, TmpMessage):
+        if fname is None:
+            fname = maildir.commit(message, mflags)
+        else:
+            maildir.abort(message)
+    elif fname is None:
+        fname = maildir.add(message, mflags)
+
+    state.put_message(fname, account, folder, uid, message_id(headers), hsh, remote_mflags(flags))
+
+
+def link_stored(maildir: Maildir, linfos: Iterable[MessageInfo], flags: str) -> str | None:
+    """Hard links the first of stored messages still in the maildir, returns the new key"""
+    toc = maildir.toc
+    for linfo in linfos:
+        if linfo.fname in toc and (fname := maildir.link(linfo.fname, flags)) is not None:
+            return fname
+    return None
+
+
+@contextmanager
+def spool_messages(maildir: Maildir, threshold: int) -> Iterator[Spool]:
+    """Streams literals larger than threshold into maildir tmp/
+
+    Spooled messages which are not committed when the block exits, e.g.
+    after a failed fetch, are removed from tmp/.
+    """
+    spooled: deque[TmpMessage] = deque()
+
+    def spool(size: int) -> LiteralSink | None:
+        if size <= threshold:
+            return None
+        # messages are committed in fetch order, committed ones are done with
+        while spooled and spooled[0].fd is None and not os.path.exists(spooled[0].path):
+            spooled.popleft()
+        tmp = maildir.spool()
+        spooled.append(tmp)
+        return tmp
+
+    try:
+        yield spool
+    finally:
+        for tmp in spooled:
+            maildir.abort(tmp)
+
+
+def remote_mflags(flags: Flags) -> str:
+    """Returns IMAP flags mapped to maildir ones"""
+    return ''.join(sorted(FLAG_MAP[f] for f in flags if f in FLAG_MAP))
+
+
+def merge_remote_flags(local: str, remote: str, synced: str | None) -> str:
+    """Applies mapped flags which changed remotely since the last sync
+
+    `synced` holds the remote flags of the last sync, other flags keep
+    their local value. If it is unknown remote flags are only added.
+    """
+    base = set(synced or '')
+    result = set(local)
+    result.difference_update(base.difference(remote))
+    result.update(set(remote).difference(base))
+    return ''.join(sorted(result))
+
+
+def sync_remote_flags(maildir: Maildir, s: Sync, folder: Folder, modseq: int) -> None:
+    apply_remote_flags(maildir, s, *folder.changed_flags(modseq))
+
+
+def apply_remote_flags(
+    maildir: Maildir, s: Sync, changed: dict[int, Flags], vanished: list[int]
+) -> None:
     state = maildir.state
-    state.put_message(fname, account, folder, uid, message_id(msg), msg.hash())
+    toc = maildir.toc
+    known = state.by_uids(s.account, s.folder, changed)
+    synced = {}
+    for uid, flags in changed.items():
+        linfo = known.get(uid)
+        if linfo is not None and linfo.fname in toc:
+            remote = remote_mflags(flags)
+            local = maildir.get_flags(linfo.fname)
+            maildir.set_flags(linfo.fname, merge_remote_flags(local, remote, linfo.flags))
+            synced[linfo.fname] = remote
+    state.set_remote_flags(synced)
+
+    if vanished:
+        state.reset_uids(s.account, s.folder, vanished)
 
 
 def update_state(maildir: Maildir) -> None:
-    # TODO: cleanup state from non-existing maildir messages
     state = maildir.state
     infos = state.getall()
     by_fname = {it.fname: it for it in infos}
 
     toc = maildir.toc
-    for fname in toc:
-        if fname not in by_fname:
-            md_msg = maildir[fname]
-            msgid = message_id(md_msg)
-            state.put_message(fname, '', '', 0, msgid, md_msg.hash())
+    with state.batch():
+        for fname in toc:
+            if fname not in by_fname:
+                data = maildir.get_bytes(fname)
+                msgid = message_id(Headers(data))
+                state.put_message(fname, '', '', 0, msgid, message_hash(data))
+
+
+def trash_index(config: NorlessConfig) -> dict[str, list[str]]:
+    """Returns trash file names by message id
+
+    Ids are kept in the state of the trash maildir, only files which
+    appeared since the previous call are parsed.
+    """
+    assert config.trash_maildir_config is not None
+    tmaildir = get_maildir(config, config.trash_maildir_config)
+    state = tmaildir.state
+    known = state.trash_entries()
+    # other folders discard trash files concurrently
+    fnames = set(tmaildir.toc)
+    with state.batch():
+        state.delete_trash([fname for fname in known if fname not in fnames])
+        for fname in fnames.difference(known):
+            try:
+                msgid = message_id(tmaildir.get_headers(fname))
+            except (KeyError, FileNotFoundError):
+                continue
+            state.put_trash(fname, msgid)
+            known[fname] = msgid
+
+    result: dict[str, list[str]] = {}
+    for fname in fnames.intersection(known):
+        result.setdefault(known[fname], []).append(fname)
+    return result
+
+
+def trashed_msgids(config: NorlessConfig) -> set[str]:
+    """Message ids in the trash maildir, their rows wait for a remote delete"""
+    if config.trash_maildir_config is None:
+        return set()
+    return set(trash_index(config))
+
+
+def collect_garbage(maildir: Maildir, keep_msgids: set[str], limit: int | None = None) -> int:
+    """Drops state rows of messages gone from the maildir and of vanished UIDs
+
+    Rows of messages moved to the trash are kept while their id is in
+    `keep_msgids`, sync_trash needs them to delete remote messages. With a
+    limit at most that many rows are checked, starting where the previous
+    call stopped. Returns the number of dropped rows.
+    """
+    state = maildir.state
+    toc = maildir.toc
+    # dropped rows of the newest messages must not make them fetched again
+    state.save_last_uids()
+    cursor = 0 if limit is None else state.get_meta('gc_cursor') or 0
+    checked = removed = 0
+    while limit is None or checked < limit:
+        size = GC_CHUNK if limit is None else min(GC_CHUNK, limit - checked)
+        rows = state.scan_messages(cursor, size)
+        dead = [
+            fname
+            for _, fname, uid, msgid in rows
+            if uid == -1 or (fname not in toc and msgid not in keep_msgids)
+        ]
+        state.delete_messages(dead)
+        removed += len(dead)
+        checked += len(rows)
+        if len(rows) < size:
+            cursor = 0
+            break
+        cursor = rows[-1][0]
+
+    state.set_meta('gc_cursor', cursor)
+    return removed
+
+
+def gc_after_sync(config: NorlessConfig) -> None:
+    keep_msgids = trashed_msgids(config)
+    for cmaildir in {s.maildir.name: s.maildir for s in config.sync_list}.values():
+        try:
+            collect_garbage(get_maildir(config, cmaildir), keep_msgids, GC_AFTER_SYNC)
+        except Exception:
+            log.exception('Error during state GC of maildir %s', cmaildir.name)
+
+
+def gc_during_idle(config: NorlessConfig, maildir: Maildir) -> None:
+    """The GC pass of gc_after_sync, at most once per IDLE_GC_INTERVAL for a maildir"""
+    with last_gc_lock:
+        now = time.monotonic()
+        last = last_gc.get(maildir.path)
+        if last is not None and now - last < IDLE_GC_INTERVAL:
+            return
+        last_gc[maildir.path] = now
+
+    try:
+        collect_garbage(maildir, trashed_msgids(config), GC_AFTER_SYNC)
+    except Exception:
+        log.exception('Error during state GC of maildir %s', maildir.path)
 
 
 def reconcile_account(config: NorlessConfig, s: Sync) -> None:
@@ -71,109 +285,360 @@ def reconcile_account(config: NorlessConfig, s: Sync) -> None:
     account = config.accounts[s.account]
     maildir = get_maildir(config, s.maildir)
     state = maildir.state
-    by_msgid = {it.msgid: it for it in state.getall()}
-    state.reset_folder_messages(s.account, s.folder)
 
     to_fetch = []
     folder = account.get_folder(s.folder)
+    infos = list(folder.info())
+    by_msgid = state.find_msgids(it.msgid for it in infos)
     found = 0
-    for rinfo in folder.info():
-        linfo = by_msgid.get(rinfo.msgid)
-        if linfo:
-            found += 1
-            state.put_message(linfo.fname, s.account, s.folder, rinfo.uid, rinfo.msgid, linfo.hash)
-        else:
-            to_fetch.append(rinfo.uid)
-
-    print('  Found messages:', found)
-    if to_fetch:
-        print('  Missing messages:', len(to_fetch))
-        for msg in folder.fetch_uids(to_fetch):
-            store_message(maildir, s.account, s.folder, int(msg['uid']), msg['body'], msg['flags'])
+    with state.batch():
+        state.reset_folder_messages(s.account, s.folder)
+        for rinfo in infos:
+            linfo = by_msgid.get(rinfo.msgid)
+            if linfo:
+                found += 1
+                state.put_message(
+                    linfo.fname,
+                    s.account,
+                    s.folder,
+                    rinfo.uid,
+                    rinfo.msgid,
+                    linfo.hash,
+                    remote_mflags(rinfo.flags),
+                )
+            else:
+                to_fetch.append(rinfo.uid)
 
-    state.set_folder(s.account, s.folder, folder.uidvalidity)
+        print('  Found messages:', found)
+        if to_fetch:
+            print('  Missing messages:', len(to_fetch))
+            with spool_messages(maildir, config.spool_threshold) as spool:
+                for msg in folder.fetch_uids(to_fetch, spool):
+                    store_message(
+                        maildir,
+                        s.account,
+                        s.folder,
+                        int(msg['uid']),
+                        msg['body'],
+                        msg['flags'],
+                        dedup=s.maildir.dedup,
+                    )
+
+        state.set_folder(s.account, s.folder, folder.uidvalidity)
 
 
 def sync_account_boxes(config: NorlessConfig, sync_list: list[Sync]) -> None:
-    for s in sync_list:
-        try:
-            sync_account_box(config, s)
-        except Exception:
-            log.exception('Error during processing account %s %s', s.account, s.folder)
+    account = config.accounts[sync_list[0].account]
+    try:
+        statuses = account.get_statuses([s.folder for s in sync_list])
+    except Exception:
+        log.exception('Error during STATUS check for account %s', account.name)
+        statuses = {}
+
+    queue = deque(sync_list)
+
+    def worker(box: ImapBox) -> None:
+        # folders are pulled from a shared queue, so an idle connection takes
+        # the next folder while others are busy with large ones
+        while queue:
+            try:
+                s = queue.popleft()
+            except IndexError:
+                break
+
+            try:
+                sync_account_box(config, s, box, statuses.get(s.folder))
+            except Exception:
+                log.exception('Error during processing account %s %s', s.account, s.folder)
+
+    changed = [
+        s
+        for s in sync_list
+        if s.folder not in statuses
+        or folder_changed(get_maildir(config, s.maildir).state, s, statuses[s.folder])
+    ]
+    connections = 1 if config.one_thread else min(account.connections, len(changed))
+    if connections <= 1:
+        worker(account)
+        return
+
+    copies = [account.copy() for _ in range(connections - 1)]
+    try:
+        threads = []
+        for box in [account] + copies:
+            t = threading.Thread(target=worker, args=(box,))
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+    finally:
+        for box in copies:
+            box.close()
+
+
+def folder_changed(state: SqliteState, s: Sync, status: Status) -> bool:
+    info = state.folder_info(s.account, s.folder)
+    return info is None or info != (
+        status.uidvalidity,
+        status.uidnext,
+        status.messages,
+        status.highestmodseq,
+    )
 
 
-def sync_account_box(config: NorlessConfig, s: Sync) -> None:
-    account = config.accounts[s.account]
-    maildir = get_maildir(config, s.maildir)
-    state = maildir.state
+def sync_account_box(
+    config: NorlessConfig,
+    s: Sync,
+    account: ImapBox | None = None,
+    status: Status | None = None,
+) -> None:
+    """Syncs one folder
 
-    toc = maildir.toc
+    A STATUS result from before SELECT matching the state of the last sync
+    means the folder did not change, only local trash is processed then.
+    """
+    account = account or config.accounts[s.account]
+    maildir = get_maildir(config, s.maildir)
     folder = account.get_folder(s.folder)
 
+    if status is None or folder_changed(maildir.state, s, status):
+        sync_remote_changes(maildir, s, folder, config.spool_threshold)
+
+    if config.trash_maildir_config is not None:
+        sync_trash(config, maildir, s, folder)
+
+
+def check_uidvalidity(state: SqliteState, s: Sync, uidvalidity: int) -> None:
     local_uidvalidity = state.uidvalidity(s.account, s.folder)
-    if folder.uidvalidity != local_uidvalidity:
+    if uidvalidity != local_uidvalidity:
         raise RuntimeError(
             f'UIDVALIDITY mismatch for {s.account}/{s.folder}: '
-            f'remote={folder.uidvalidity}, local={local_uidvalidity}'
+            f'remote={uidvalidity}, local={local_uidvalidity}'
+        )
+
+
+def flags_outdated(state: SqliteState, s: Sync, remote_modseq: int | None) -> int | None:
+    """Returns local modseq if remote flags changed since the last sync"""
+    modseq = state.modseq(s.account, s.folder)
+    if modseq is not None and remote_modseq is not None and remote_modseq > modseq:
+        return modseq
+    return None
+
+
+def plan_new_messages(
+    maildir: Maildir, s: Sync, infos: Iterable[Info]
+) -> tuple[list[int], list[int]]:
+    """Returns UIDs to fetch and UIDs to mark as seen on remote"""
+    state = maildir.state
+    toc = maildir.toc
+    to_seen = []
+    to_fetch = []
+    mark_as_seen = s.maildir.mark_as_seen
+
+    infos = list(infos)
+    known = state.by_uids(s.account, s.folder, [it.uid for it in infos])
+    for rinfo in infos:
+        linfo = known.get(rinfo.uid)
+        if linfo is None:
+            to_fetch.append(rinfo.uid)
+            if mark_as_seen:
+                to_seen.append(rinfo.uid)
+        elif toc_entry := toc.get(linfo.fname):
+            if 'S' in toc_entry[1]:
+                to_seen.append(rinfo.uid)
+
+    return to_fetch, to_seen
+
+
+def save_folder_status(state: SqliteState, s: Sync, folder: Folder | AsyncFolder) -> None:
+    if folder.uidnext is not None:
+        state.set_folder_status(
+            s.account, s.folder, folder.uidnext, folder.total, folder.highestmodseq
         )
 
+
+def sync_remote_changes(maildir: Maildir, s: Sync, folder: Folder, spool_threshold: int) -> None:
+    state = maildir.state
+
+    # SELECT and UID SEARCH go out in one round trip, search result is
+    # discarded on UIDVALIDITY mismatch
     new_uids = folder.uids_since(state.max_uid(s.account, s.folder))
+    check_uidvalidity(state, s, folder.uidvalidity)
+
+    with state.batch():
+        if (modseq := flags_outdated(state, s, folder.highestmodseq)) is not None:
+            sync_remote_flags(maildir, s, folder, modseq)
+
+        if new_uids:
+            to_fetch, to_seen = plan_new_messages(maildir, s, folder.info(new_uids))
+            with spool_messages(maildir, spool_threshold) as spool:
+                for msg in folder.fetch_uids(to_fetch, spool):
+                    store_message(
+                        maildir,
+                        s.account,
+                        s.folder,
+                        int(msg['uid']),
+                        msg['body'],
+                        msg['flags'],
+                        seen=s.maildir.mark_as_seen,
+                        dedup=s.maildir.dedup,
+                    )
+
+            if to_seen:
+                folder.seen(to_seen)
+
+        # folder status is committed after the rows of fetched messages
+        save_folder_status(state, s, folder)
+
+
+def find_trashed(config: NorlessConfig, maildir: Maildir, s: Sync) -> tuple[list[int], set[str]]:
+    """Returns UIDs of locally deleted messages and their trash file names"""
+    assert config.trash_maildir_config is not None
+    state = maildir.state
+    toc = maildir.toc
 
-    if new_uids:
-        to_seen = []
-        to_fetch = []
-        mark_as_seen = s.maildir.mark_as_seen
+    to_delete = []
+    to_discard = set()
 
-        for rinfo in folder.info(new_uids):
-            linfo = state.by_uid(s.account, s.folder, rinfo.uid)
-            if linfo is None:
-                to_fetch.append(rinfo.uid)
-                if mark_as_seen:
-                    to_seen.append(rinfo.uid)
-            elif toc_entry := toc.get(linfo.fname):
-                if 'S' in toc_entry[1]:
-                    to_seen.append(rinfo.uid)
+    trashed = trash_index(config)
+    for msgid, linfos in state.by_msgids(s.account, s.folder, trashed).items():
+        for linfo in linfos:
+            if linfo.fname not in toc:
+                to_delete.append(linfo.uid)
+                to_discard.update(trashed[msgid])
+
+    return to_delete, to_discard
+
+
+def discard_trashed(config: NorlessConfig, to_discard: set[str]) -> None:
+    assert config.trash_maildir_config is not None
+    tmaildir = get_maildir(config, config.trash_maildir_config)
+    for fname in to_discard:
+        tmaildir.discard(fname)
+    tmaildir.state.delete_trash(to_discard)
 
-        if to_fetch:
-            for msg in folder.fetch_uids(to_fetch):
-                store_message(
-                    maildir,
-                    s.account,
-                    s.folder,
-                    int(msg['uid']),
-                    msg['body'],
-                    msg['flags'],
-                    seen=mark_as_seen,
-                )
 
-        if to_seen:
-            folder.seen(to_seen)
+def sync_trash(config: NorlessConfig, maildir: Maildir, s: Sync, folder: Folder) -> None:
+    to_delete, to_discard = find_trashed(config, maildir, s)
+    if to_delete:
+        folder.delete(to_delete)
+    discard_trashed(config, to_discard)
+
+
+async def async_sync_remote_changes(
+    maildir: Maildir, s: Sync, folder: AsyncFolder, spool_threshold: int
+) -> None:
+    """sync_remote_changes over an asyncio connection"""
+    state = maildir.state
+
+    new_uids = await folder.uids_since(state.max_uid(s.account, s.folder))
+    check_uidvalidity(state, s, folder.uidvalidity)
+
+    with state.batch():
+        if (modseq := flags_outdated(state, s, folder.highestmodseq)) is not None:
+            apply_remote_flags(maildir, s, *await folder.changed_flags(modseq))
+
+        if new_uids:
+            infos = [it async for it in folder.info(new_uids)]
+            to_fetch, to_seen = plan_new_messages(maildir, s, infos)
+            with spool_messages(maildir, spool_threshold) as spool:
+                async for msg in folder.fetch_uids(to_fetch, spool):
+                    store_message(
+                        maildir,
+                        s.account,
+                        s.folder,
+                        int(msg['uid']),
+                        msg['body'],
+                        msg['flags'],
+                        seen=s.maildir.mark_as_seen,
+                        dedup=s.maildir.dedup,
+                    )
+
+            if to_seen:
+                await folder.seen(to_seen)
+
+        save_folder_status(state, s, folder)
+
+
+async def async_sync_account_box(
+    config: NorlessConfig, s: Sync, account: AsyncImapBox, status: Status | None = None
+) -> None:
+    maildir = get_maildir(config, s.maildir)
+    folder = account.get_folder(s.folder)
+
+    if status is None or folder_changed(maildir.state, s, status):
+        await async_sync_remote_changes(maildir, s, folder, config.spool_threshold)
 
     if config.trash_maildir_config is not None:
-        to_delete = []
-        to_discard = set()
-
-        tmaildir = get_maildir(config, config.trash_maildir_config)
-        for fname in tmaildir.toc:
-            trash_msg = tmaildir[fname]
-            for linfo in state.by_msgid(s.account, s.folder, message_id(trash_msg)):
-                if linfo.fname not in toc:
-                    to_delete.append(linfo.uid)
-                    to_discard.add(fname)
-
-        # print(s.account, s.folder, to_delete, to_discard)
+        to_delete, to_discard = find_trashed(config, maildir, s)
         if to_delete:
-            folder.delete(to_delete)
+            await folder.delete(to_delete)
+        discard_trashed(config, to_discard)
 
-        for fname in to_discard:
-            tmaildir.discard(fname)
+
+async def async_sync_account_boxes(
+    config: NorlessConfig, sync_list: list[Sync], account: AsyncImapBox | None = None
+) -> None:
+    """sync_account_boxes with connections served by one event loop"""
+    account = account or AsyncImapBox(config.accounts[sync_list[0].account], config.timeout or None)
+    try:
+        statuses = await account.get_statuses([s.folder for s in sync_list])
+    except Exception:
+        log.exception('Error during STATUS check for account %s', account.name)
+        statuses = {}
+
+    queue = deque(sync_list)
+
+    async def worker(box: AsyncImapBox) -> None:
+        while queue:
+            s = queue.popleft()
+            try:
+                await async_sync_account_box(config, s, box, statuses.get(s.folder))
+            except Exception:
+                log.exception('Error during processing account %s %s', s.account, s.folder)
+
+    changed = [
+        s
+        for s in sync_list
+        if s.folder not in statuses
+        or folder_changed(get_maildir(config, s.maildir).state, s, statuses[s.folder])
+    ]
+    connections = 1 if config.one_thread else min(account.connections, len(changed))
+    boxes = [account] + [account.copy() for _ in range(connections - 1)]
+    try:
+        await asyncio.gather(*(worker(box) for box in boxes))
+    finally:
+        for box in boxes:
+            await box.close()
+
+
+async def async_sync(config: NorlessConfig) -> None:
+    accounts = config.sync_by_account()
+    if config.one_thread:
+        for name, sync_list in accounts.items():
+            try:
+                await async_sync_account_boxes(config, sync_list)
+            except Exception:
+                log.exception('Error during sync of account %s', name)
+    else:
+        # a failed account does not cancel the others
+        results = await asyncio.gather(
+            *(async_sync_account_boxes(config, sync_list) for sync_list in accounts.values()),
+            return_exceptions=True,
+        )
+        for name, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                log.error('Error during sync of account %s', name, exc_info=result)
 
 
 def do_sync(config: NorlessConfig) -> None:
     with config.app_lock():
         accounts = config.sync_by_account()
 
-        if config.one_thread:
+        if config.use_asyncio:
+            asyncio.run(async_sync(config))
+        elif config.one_thread:
             for sync_list in accounts.values():
                 sync_account_boxes(config, sync_list)
         else:
@@ -187,6 +652,149 @@ def do_sync(config: NorlessConfig) -> None:
             for t in threads:
                 t.join()
 
+        gc_after_sync(config)
+
+
+class LocalChanges:
+    """Maildir changes for the idle loop of a folder, readable fileno wakes it up"""
+
+    def __init__(self) -> None:
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+        self._changes: list[Change] = []
+        self._lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self._rfd
+
+    def put(self, change: Change) -> None:
+        with self._lock:
+            self._changes.append(change)
+        try:
+            os.write(self._wfd, b'.')
+        except BlockingIOError:
+            pass  # already signalled
+
+    def take(self) -> list[Change]:
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            changes, self._changes = self._changes, []
+        return changes
+
+
+def push_local_changes(
+    config: NorlessConfig, maildir: Maildir, s: Sync, folder: Folder, changes: list[Change]
+) -> None:
+    """Sends changes noticed by the maildir watcher to the server
+
+    Messages which got the seen flag are marked as seen, messages which
+    appeared in the trash are deleted.
+    """
+    if config.trash_maildir_config is not None and any(
+        it.maildir is not maildir or it.kind == 'rescan' for it in changes
+    ):
+        sync_trash(config, maildir, s, folder)
+
+    state = maildir.state
+    toc = maildir.toc
+    to_seen = []
+    for key in {it.msgkey for it in changes if it.maildir is maildir and it.kind == 'flags'}:
+        linfo = state.by_message_fname(key)
+        entry = toc.get(key)
+        if (
+            linfo is not None
+            and entry is not None
+            and (linfo.account, linfo.folder) == (s.account, s.folder)
+            and linfo.uid > 0
+            and 'S' in parse_info(entry[1])
+        ):
+            to_seen.append(linfo.uid)
+
+    if to_seen:
+        folder.seen(to_seen)
+
+
+def watch_maildirs(config: NorlessConfig, routes: list[tuple[Sync, LocalChanges]]) -> None:
+    """Routes changes made by other programs in synced and trash maildirs"""
+    by_maildir: dict[Maildir, list[LocalChanges]] = {}
+    for s, local in routes:
+        by_maildir.setdefault(get_maildir(config, s.maildir), []).append(local)
+
+    trash = None
+    if config.trash_maildir_config is not None:
+        trash = get_maildir(config, config.trash_maildir_config)
+
+    maildirs = list(by_maildir)
+    if trash is not None and trash not in by_maildir:
+        maildirs.append(trash)
+    watcher = MaildirWatcher(maildirs)
+
+    def run() -> None:
+        while True:
+            try:
+                select.select([watcher], [], [])
+                for change in watcher.read():
+                    if change.maildir is trash:
+                        if change.kind in ('added', 'rescan'):
+                            for _, local in routes:
+                                local.put(change)
+                    elif change.kind in ('flags', 'rescan'):
+                        for local in by_maildir[change.maildir]:
+                            local.put(change)
+            except Exception:
+                log.exception('Error during watching maildirs')
+                time.sleep(IDLE_RETRY_DELAY)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def idle_account_box(config: NorlessConfig, s: Sync, local: LocalChanges | None = None) -> None:
+    maildir = get_maildir(config, s.maildir)
+    while True:
+        # every synced folder idles on its own connection
+        account = config.accounts[s.account].copy()
+        try:
+            sync_account_box(config, s, account)
+            gc_during_idle(config, maildir)
+            folder = account.get_folder(s.folder)
+            while True:
+                if folder.wait_changes(wakeup=local.fileno() if local else None):
+                    sync_account_box(config, s, account)
+                    gc_during_idle(config, maildir)
+                if local and (changes := local.take()):
+                    push_local_changes(config, maildir, s, folder, changes)
+        except Exception:
+            log.exception('Error during idle for account %s %s', s.account, s.folder)
+        finally:
+            # a broken connection is replaced by a new one
+            account.close()
+        time.sleep(IDLE_RETRY_DELAY)
+
+
+def do_idle(config: NorlessConfig) -> None:
+    with config.app_lock():
+        routes = [(s, LocalChanges()) for s in config.sync_list]
+        watched: list[LocalChanges | None] = [local for _, local in routes]
+        try:
+            watch_maildirs(config, routes)
+        except OSError:
+            log.warning('Local maildir changes are not watched', exc_info=True)
+            watched = [None] * len(routes)
+
+        threads = []
+        for s, local in zip(config.sync_list, watched):
+            t = threading.Thread(target=idle_account_box, args=(config, s, local), daemon=True)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
 
 def do_reconcile(config: NorlessConfig) -> None:
     with config.app_lock():
@@ -201,6 +809,15 @@ def do_reconcile(config: NorlessConfig) -> None:
                     log.exception('Error during processing account %s %s', s.account, s.folder)
 
 
+def do_gc(config: NorlessConfig) -> None:
+    with config.app_lock():
+        keep_msgids = trashed_msgids(config)
+        for m in config.maildirs.values():
+            removed = collect_garbage(get_maildir(config, m), keep_msgids)
+            if not config.quiet:
+                print('GC:', m.name, '-', removed, 'state rows dropped')
+
+
 def do_check(config: NorlessConfig) -> None:
     result = Counter[str]()
     for cmaildir in {s.maildir.name: s.maildir for s in config.sync_list}.values():
@@ -210,7 +827,7 @@ def do_check(config: NorlessConfig) -> None:
                 result[cmaildir.name] += 1
 
     for k, v in result.items():
-        print('{}\t{}'.format(k, v))
+        print(f'{k}\t{v}')
 
     if not result:
         sys.exit(1)
@@ -226,14 +843,16 @@ def do_show_folders(config: NorlessConfig) -> None:
             else:
                 lname = f' ({dname})'
 
-            print('   [{}] {}\t({}){}'.format(s, name, f, lname))
+            print(f'   [{s}] {name}\t({f}){lname}')
 
 
 ACTIONS = [
     do_show_folders,
     do_reconcile,
     do_sync,
+    do_gc,
     do_check,
+    do_idle,
 ]
 
 
@@ -271,6 +890,22 @@ commands to get certificates:
         help='command: recreate state and fetch missing messages from remote maildirs',
     )
 
+    parser.add_argument(
+        '--gc',
+        dest='actions',
+        action='append_const',
+        const=do_gc,
+        help='command: drop state of messages missing from local maildir(s) or remote',
+    )
+
+    parser.add_argument(
+        '--idle',
+        dest='actions',
+        action='append_const',
+        const=do_idle,
+        help='command: keep syncing folders as soon as the server reports changes',
+    )
+
     parser.add_argument(
         '--show-folders',
         dest='actions',
@@ -298,6 +933,13 @@ commands to get certificates:
         help='run actions sequentially in one thread',
     )
 
+    parser.add_argument(
+        '--asyncio',
+        dest='use_asyncio',
+        action='store_true',
+        help='sync all connections from one asyncio event loop instead of threads',
+    )
+
     parser.add_argument(
         '-d',
         '--debug',
@@ -315,6 +957,7 @@ commands to get certificates:
         account=args.account,
         maildir=args.maildir,
         one_thread=args.one_thread,
+        use_asyncio=args.use_asyncio,
         quiet=args.quiet,
         debug=args.debug,
     )
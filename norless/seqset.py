@@ -0,0 +1,58 @@
+"""IMAP sequence sets (RFC 3501)"""
+
+from collections.abc import Iterable, Iterator
+
+# RFC 7162 asks clients to keep command lines within 8192 octets
+MAX_LENGTH = 4096
+
+
+def ranges(uids: Iterable[int]) -> Iterator[tuple[int, int]]:
+    it = iter(sorted(set(uids)))
+    for start in it:
+        end = start
+        for uid in it:
+            if uid != end + 1:
+                yield start, end
+                start = uid
+            end = uid
+        yield start, end
+
+
+def _format(start: int, end: int) -> bytes:
+    if start == end:
+        return b'%d' % start
+    return b'%d:%d' % (start, end)
+
+
+def encode(uids: Iterable[int]) -> bytes:
+    """Range-compresses numbers into a sequence set: 1:5000,5002"""
+    return b','.join(_format(start, end) for start, end in ranges(uids))
+
+
+def split(uids: Iterable[int], limit: int = MAX_LENGTH) -> Iterator[bytes]:
+    """Like encode but yields sets no longer than limit"""
+    parts: list[bytes] = []
+    size = 0
+    for start, end in ranges(uids):
+        part = _format(start, end)
+        if parts and size + len(part) > limit:
+            yield b','.join(parts)
+            parts = []
+            size = 0
+        parts.append(part)
+        size += len(part) + 1
+
+    if parts:
+        yield b','.join(parts)
+
+
+def decode(value: bytes) -> list[int]:
+    result: list[int] = []
+    for part in value.split(b','):
+        start, sep, end = part.partition(b':')
+        if sep:
+            lo, hi = sorted((int(start), int(end)))
+            result.extend(range(lo, hi + 1))
+        else:
+            result.append(int(start))
+    return result
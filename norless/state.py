@@ -1,7 +1,33 @@
+"""Sync state of a maildir
+
+Writes are either committed one by one or, inside `SqliteState.batch`,
+queued in memory and committed together. A message file is always linked
+into new/ or cur/ before its row is written, so a committed row never
+points at a message which was not stored. After a power loss this holds
+only if the maildir fsyncs messages, per message or via `before_commit`
+in group and syncfs modes. A crash in the middle of a batch loses queued rows only:
+their messages stay in the maildir unknown to the state, the next sync
+fetches them again and `--reconcile` picks up the extra files.
+"""
+
+import json
 import os.path
 import sqlite3
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from itertools import groupby
+from time import monotonic
+from typing import Any, NamedTuple
+
+# a batch is committed once it holds this many rows or is this old
+BATCH_ROWS = 1000
+BATCH_INTERVAL = 1.0
 
-from typing import NamedTuple
+SELECT_MESSAGES = (
+    'SELECT m.fname, f.account, f.folder, m.uid, m.msgid, m.hash, m.flags '
+    'FROM messages m JOIN folders f ON f.id = m.folder_id '
+)
+FOLDER_ID = '(SELECT id FROM folders WHERE account=? AND folder=?)'
 
 
 class Row(NamedTuple):
@@ -16,6 +42,13 @@ class Info(NamedTuple):
     msgid: str
 
 
+class FolderInfo(NamedTuple):
+    uidvalidity: int
+    uidnext: int | None
+    messages: int | None
+    modseq: int | None
+
+
 class MessageInfo(NamedTuple):
     fname: str
     account: str
@@ -23,6 +56,8 @@ class MessageInfo(NamedTuple):
     uid: int
     msgid: str
     hash: str
+    # remote flags as maildir letters at the last sync, None if unknown
+    flags: str | None = None
 
 
 def connect(fname: str) -> sqlite3.Connection:
@@ -35,6 +70,7 @@ def connect(fname: str) -> sqlite3.Connection:
 
 
 def create_tables(conn: sqlite3.Connection) -> None:
+    """Schema from before versioning, databases of that age are upgraded from here"""
     conn.execute("""CREATE TABLE IF NOT EXISTS folders (
         account text,
         folder text,
@@ -57,61 +93,338 @@ def create_tables(conn: sqlite3.Connection) -> None:
         'CREATE INDEX IF NOT EXISTS messages_account_folder_hash_idx '
         'ON messages (account, folder, hash)'
     )
-    conn.commit()
+
+    columns = {row[1] for row in conn.execute('pragma table_info(folders)')}
+    for name in ('modseq', 'uidnext', 'messages'):
+        if name not in columns:
+            conn.execute(f'ALTER TABLE folders ADD COLUMN {name} integer')
+
+
+def normalize_folders(conn: sqlite3.Connection) -> None:
+    """Messages refer to folders by an integer id, message ids are indexed"""
+    conn.execute("""CREATE TABLE folders_new (
+        id integer PRIMARY KEY,
+        account text NOT NULL,
+        folder text NOT NULL,
+        uidvalidity integer,
+        uidnext integer,
+        messages integer,
+        modseq integer,
+        UNIQUE (account, folder)
+    )""")
+    conn.execute(
+        'INSERT INTO folders_new (account, folder, uidvalidity, uidnext, messages, modseq) '
+        "SELECT coalesce(account, ''), coalesce(folder, ''), uidvalidity, uidnext, messages, "
+        'modseq FROM folders'
+    )
+    conn.execute(
+        'INSERT OR IGNORE INTO folders_new (account, folder) '
+        "SELECT DISTINCT coalesce(account, ''), coalesce(folder, '') FROM messages"
+    )
+
+    conn.execute("""CREATE TABLE messages_new (
+        fname text PRIMARY KEY,
+        folder_id integer NOT NULL REFERENCES folders (id),
+        uid integer,
+        msgid text,
+        hash text
+    )""")
+    conn.execute(
+        'INSERT INTO messages_new (fname, folder_id, uid, msgid, hash) '
+        'SELECT m.fname, f.id, m.uid, m.msgid, m.hash FROM messages m JOIN folders_new f '
+        "ON f.account = coalesce(m.account, '') AND f.folder = coalesce(m.folder, '')"
+    )
+
+    conn.execute('DROP TABLE messages')
+    conn.execute('DROP TABLE folders')
+    conn.execute('ALTER TABLE folders_new RENAME TO folders')
+    conn.execute('ALTER TABLE messages_new RENAME TO messages')
+    conn.execute('CREATE INDEX messages_folder_uid_idx ON messages (folder_id, uid)')
+    conn.execute('CREATE INDEX messages_msgid_idx ON messages (msgid, folder_id)')
+
+
+def create_meta(conn: sqlite3.Connection) -> None:
+    """Key-value table for bookkeeping like the GC position"""
+    conn.execute('CREATE TABLE meta (name text PRIMARY KEY, value)')
+
+
+def create_trash(conn: sqlite3.Connection) -> None:
+    """Message ids of files in a trash maildir, kept by SqliteState.put_trash"""
+    conn.execute('CREATE TABLE trash (fname text PRIMARY KEY, msgid text)')
+
+
+def index_hashes(conn: sqlite3.Connection) -> None:
+    """Looks up messages by hash in all folders for deduplication"""
+    # replaces a per-folder hash index no query used
+    conn.execute('DROP INDEX IF EXISTS messages_folder_hash_idx')
+    conn.execute('CREATE INDEX messages_hash_idx ON messages (hash)')
+
+
+def add_last_uid(conn: sqlite3.Connection) -> None:
+    """Highest UID synced in a folder, rows of the newest messages may be pruned"""
+    conn.execute('ALTER TABLE folders ADD COLUMN last_uid integer')
+    conn.execute(
+        'UPDATE folders SET last_uid=(SELECT MAX(uid) FROM messages WHERE folder_id=folders.id)'
+    )
+
+
+def add_remote_flags(conn: sqlite3.Connection) -> None:
+    """Remote flags of a message at the last sync, base of the flag merge"""
+    conn.execute('ALTER TABLE messages ADD COLUMN flags text')
+
+
+# applied in order, `pragma user_version` is the number of applied ones,
+# append new migrations to the end
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    create_tables,
+    normalize_folders,
+    create_meta,
+    create_trash,
+    index_hashes,
+    add_last_uid,
+    add_remote_flags,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    if conn.execute('pragma user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+
+    # the version is checked again under the write lock, another
+    # connection might have migrated the database in between
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('pragma user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(conn)
+            conn.execute(f'pragma user_version = {number}')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
 
 
 class SqliteState:
     def __init__(self, maildir_path: str):
         fname = os.path.join(maildir_path, 'state.sqlite')
         self.conn = connect(fname)
-        create_tables(self.conn)
+        migrate(self.conn)
+        self._folder_ids: dict[tuple[str, str], int] = {}
+        self._batches = 0
+        self._batch_rows = BATCH_ROWS
+        self._batch_interval = BATCH_INTERVAL
+        self._queue: list[tuple[str, tuple[Any, ...]]] = []
+        # messages of queued rows by hash, see by_hash
+        self._queued_hashes: dict[str, list[MessageInfo]] = {}
+        self._queued_at = 0.0
+        # called before writes are committed, makes files they refer to durable
+        self.before_commit: Callable[[], None] | None = None
+
+    @contextmanager
+    def batch(self, rows: int = BATCH_ROWS, interval: float = BATCH_INTERVAL) -> Iterator[None]:
+        """Queues writes and commits them every `rows` rows or `interval` seconds
+
+        Queued rows are committed on exit, also when the block raises:
+        messages are already in the maildir by then. Reads flush the queue
+        first, nested batches are committed by the outermost one.
+        """
+        if not self._batches:
+            self._batch_rows = rows
+            self._batch_interval = interval
+        self._batches += 1
+        try:
+            yield
+        finally:
+            self._batches -= 1
+            if not self._batches:
+                self.flush()
+
+    def flush(self) -> None:
+        """Commits queued writes in one transaction"""
+        queue, self._queue = self._queue, []
+        self._queued_hashes = {}
+        if not queue:
+            return
+
+        if self.before_commit is not None:
+            self.before_commit()
+        self.conn.execute('BEGIN')
+        try:
+            for sql, items in groupby(queue, key=lambda it: it[0]):
+                self.conn.executemany(sql, [params for _, params in items])
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def _write(self, sql: str, params: tuple[Any, ...]) -> None:
+        if not self._batches:
+            if self.before_commit is not None:
+                self.before_commit()
+            self.conn.execute(sql, params)
+            self.conn.commit()
+            return
+
+        if not self._queue:
+            self._queued_at = monotonic()
+        self._queue.append((sql, params))
+        if (
+            len(self._queue) >= self._batch_rows
+            or monotonic() - self._queued_at >= self._batch_interval
+        ):
+            self.flush()
+
+    def _query(self, sql: str, params: tuple[Any, ...] = ()) -> sqlite3.Cursor:
+        if self._queue:
+            self.flush()
+        return self.conn.execute(sql, params)
+
+    def _folder_id(self, account: str, folder: str) -> int:
+        key = account, folder
+        try:
+            return self._folder_ids[key]
+        except KeyError:
+            pass
+
+        # committed right away, queued rows may refer to the id
+        self.conn.execute('INSERT OR IGNORE INTO folders (account, folder) VALUES (?, ?)', key)
+        (folder_id,) = self.conn.execute(
+            'SELECT id FROM folders WHERE account=? AND folder=?', key
+        ).fetchone()
+        self._folder_ids[key] = folder_id
+        return int(folder_id)
+
+    def get_meta(self, name: str) -> Any:
+        rows = self._query('SELECT value FROM meta WHERE name=?', (name,)).fetchall()
+        if rows:
+            return rows[0][0]
+        return None
+
+    def set_meta(self, name: str, value: Any) -> None:
+        self._write('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+    def scan_messages(self, after: int, limit: int) -> list[tuple[int, str, int, str]]:
+        """Returns up to `limit` (rowid, fname, uid, msgid) rows following the `after` rowid"""
+        return self._query(
+            'SELECT rowid, fname, uid, msgid FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            (after, limit),
+        ).fetchall()
+
+    def delete_messages(self, fnames: Iterable[str]) -> None:
+        with self.batch():
+            for fname in fnames:
+                self._write('DELETE FROM messages WHERE fname=?', (fname,))
+
+    def trash_entries(self) -> dict[str, str]:
+        """Returns message ids by file name of the trash maildir"""
+        return dict(self._query('SELECT fname, msgid FROM trash').fetchall())
+
+    def put_trash(self, fname: str, msgid: str) -> None:
+        self._write('INSERT OR REPLACE INTO trash (fname, msgid) VALUES (?, ?)', (fname, msgid))
+
+    def delete_trash(self, fnames: Iterable[str]) -> None:
+        with self.batch():
+            for fname in fnames:
+                self._write('DELETE FROM trash WHERE fname=?', (fname,))
 
     def getall(self) -> list[MessageInfo]:
-        result = self.conn.execute('SELECT fname, account, folder, uid, msgid, hash FROM messages')
+        result = self._query(SELECT_MESSAGES)
         return [MessageInfo(*r) for r in result]
 
     def uidvalidity(self, account: str, folder: str) -> int | None:
         params = account, folder
-        rows = self.conn.execute(
+        rows = self._query(
             'SELECT uidvalidity FROM folders WHERE account=? AND folder=? LIMIT 1',
             params,
         ).fetchall()
-        if rows:
+        if rows and rows[0][0] is not None:
             return int(rows[0][0])
         return None
 
     def set_folder(self, account: str, folder: str, uidvalidity: int) -> None:
         params = account, folder, uidvalidity
-        self.conn.execute(
-            'INSERT OR REPLACE INTO folders (account, folder, uidvalidity) VALUES (?, ?, ?)',
+        # a new UIDVALIDITY invalidates the last seen status and UIDs
+        self._write(
+            'INSERT INTO folders (account, folder, uidvalidity) VALUES (?, ?, ?) '
+            'ON CONFLICT (account, folder) DO UPDATE SET uidvalidity=excluded.uidvalidity, '
+            'uidnext=NULL, messages=NULL, modseq=NULL, last_uid=CASE '
+            'WHEN uidvalidity=excluded.uidvalidity THEN last_uid END',
+            params,
+        )
+
+    def modseq(self, account: str, folder: str) -> int | None:
+        params = account, folder
+        rows = self._query(
+            'SELECT modseq FROM folders WHERE account=? AND folder=? LIMIT 1',
+            params,
+        ).fetchall()
+        if rows and rows[0][0] is not None:
+            return int(rows[0][0])
+        return None
+
+    def folder_info(self, account: str, folder: str) -> FolderInfo | None:
+        params = account, folder
+        rows = self._query(
+            'SELECT uidvalidity, uidnext, messages, modseq FROM folders '
+            'WHERE account=? AND folder=? LIMIT 1',
+            params,
+        ).fetchall()
+        if rows and rows[0][0] is not None:
+            return FolderInfo(*rows[0])
+        return None
+
+    def set_folder_status(
+        self, account: str, folder: str, uidnext: int, messages: int, modseq: int | None
+    ) -> None:
+        params = uidnext, messages, modseq, account, folder
+        self._write(
+            'UPDATE folders SET uidnext=?, messages=?, modseq=? WHERE account=? AND folder=?',
             params,
         )
-        self.conn.commit()
+
+    def save_last_uids(self) -> None:
+        """Remembers the highest UID of each folder before its rows are pruned"""
+        self._write(
+            'UPDATE folders SET last_uid=max(coalesce(last_uid, 0), coalesce('
+            '(SELECT MAX(uid) FROM messages WHERE folder_id=folders.id), 0))',
+            (),
+        )
 
     def folder_messages(self, account: str, folder: str) -> list[MessageInfo]:
         params = account, folder
-        result = self.conn.execute(
-            'SELECT fname, account, folder, uid, msgid, hash FROM messages '
-            'WHERE account=? AND folder=?',
+        result = self._query(
+            SELECT_MESSAGES + 'WHERE f.account=? AND f.folder=?',
             params,
         )
         return [MessageInfo(*r) for r in result]
 
     def by_uid(self, account: str, folder: str, uid: int) -> MessageInfo | None:
         params = account, folder, uid
-        rows = self.conn.execute(
-            'SELECT fname, account, folder, uid, msgid, hash FROM messages '
-            'WHERE account=? AND folder=? AND uid=? LIMIT 1',
+        rows = self._query(
+            SELECT_MESSAGES + 'WHERE f.account=? AND f.folder=? AND m.uid=? LIMIT 1',
             params,
         ).fetchall()
         if rows:
             return MessageInfo(*rows[0])
         return None
 
+    def by_uids(self, account: str, folder: str, uids: Iterable[int]) -> dict[int, MessageInfo]:
+        """Looks up many UIDs in one query"""
+        params = account, folder, json.dumps(list(uids))
+        result = self._query(
+            SELECT_MESSAGES
+            + 'WHERE f.account=? AND f.folder=? AND m.uid IN (SELECT value FROM json_each(?))',
+            params,
+        )
+        return {r[3]: MessageInfo(*r) for r in result}
+
     def max_uid(self, account: str, folder: str) -> int:
+        """Returns the highest synced UID, also if GC pruned its row"""
         params = account, folder
-        rows = self.conn.execute(
-            'SELECT MAX(uid) FROM messages WHERE account=? AND folder=?',
+        rows = self._query(
+            'SELECT max(coalesce(last_uid, 0), coalesce('
+            '(SELECT MAX(uid) FROM messages WHERE folder_id=folders.id), 0)) '
+            'FROM folders WHERE account=? AND folder=?',
             params,
         ).fetchall()
         if rows and rows[0][0] is not None:
@@ -120,17 +433,49 @@ class SqliteState:
 
     def by_msgid(self, account: str, folder: str, msgid: str) -> list[MessageInfo]:
         params = account, folder, msgid
-        result = self.conn.execute(
-            'SELECT fname, account, folder, uid, msgid, hash FROM messages '
-            'WHERE account=? AND folder=? AND msgid=?',
+        result = self._query(
+            SELECT_MESSAGES + 'WHERE f.account=? AND f.folder=? AND m.msgid=?',
             params,
         )
         return [MessageInfo(*r) for r in result]
 
+    def by_msgids(
+        self, account: str, folder: str, msgids: Iterable[str]
+    ) -> dict[str, list[MessageInfo]]:
+        """Looks up many message ids in one query"""
+        params = account, folder, json.dumps(list(msgids))
+        result = self._query(
+            SELECT_MESSAGES
+            + 'WHERE f.account=? AND f.folder=? AND m.msgid IN (SELECT value FROM json_each(?))',
+            params,
+        )
+        found: dict[str, list[MessageInfo]] = {}
+        for r in result:
+            found.setdefault(r[4], []).append(MessageInfo(*r))
+        return found
+
+    def find_msgids(self, msgids: Iterable[str]) -> dict[str, MessageInfo]:
+        """Returns a message for each known id looked up in all folders"""
+        params = (json.dumps(list(msgids)),)
+        result = self._query(
+            SELECT_MESSAGES + 'WHERE m.msgid IN (SELECT value FROM json_each(?))', params
+        )
+        return {r[4]: MessageInfo(*r) for r in result}
+
+    def by_hash(self, hash_value: str) -> list[MessageInfo]:
+        """Returns messages with the given hash in all folders
+
+        Unlike other reads it does not flush queued writes, their messages
+        are looked up in memory. It runs for every stored message and would
+        commit a batch row by row otherwise.
+        """
+        result = self.conn.execute(SELECT_MESSAGES + 'WHERE m.hash=?', (hash_value,))
+        return self._queued_hashes.get(hash_value, []) + [MessageInfo(*r) for r in result]
+
     def by_message_fname(self, fname: str) -> MessageInfo | None:
         params = (fname,)
-        rows = self.conn.execute(
-            'SELECT fname, account, folder, uid, msgid, hash FROM messages WHERE fname=? LIMIT 1',
+        rows = self._query(
+            SELECT_MESSAGES + 'WHERE m.fname=? LIMIT 1',
             params,
         ).fetchall()
         if rows:
@@ -138,17 +483,39 @@ class SqliteState:
         return None
 
     def put_message(
-        self, fname: str, account: str, folder: str, uid: int, msgid: str, hash_value: str
+        self,
+        fname: str,
+        account: str,
+        folder: str,
+        uid: int,
+        msgid: str,
+        hash_value: str,
+        flags: str | None = None,
     ) -> None:
-        params = fname, account, folder, uid, msgid, hash_value
-        self.conn.execute(
-            'INSERT OR REPLACE INTO messages (fname, account, folder, uid, msgid, hash) '
+        params = fname, self._folder_id(account, folder), uid, msgid, hash_value, flags
+        if self._batches:
+            info = MessageInfo(fname, account, folder, uid, msgid, hash_value, flags)
+            self._queued_hashes.setdefault(hash_value, []).append(info)
+        self._write(
+            'INSERT OR REPLACE INTO messages (fname, folder_id, uid, msgid, hash, flags) '
             'VALUES (?, ?, ?, ?, ?, ?)',
             params,
         )
-        self.conn.commit()
+
+    def set_remote_flags(self, flags: dict[str, str]) -> None:
+        """Remembers remote flags by file name after they were merged"""
+        with self.batch():
+            for fname, value in flags.items():
+                self._write('UPDATE messages SET flags=? WHERE fname=?', (value, fname))
 
     def reset_folder_messages(self, account: str, folder: str) -> None:
         params = account, folder
-        self.conn.execute('UPDATE messages SET uid=-1 WHERE account=? AND folder=?', params)
-        self.conn.commit()
+        self._write('UPDATE messages SET uid=-1 WHERE folder_id=' + FOLDER_ID, params)
+
+    def reset_uids(self, account: str, folder: str, uids: list[int]) -> None:
+        with self.batch():
+            for uid in uids:
+                self._write(
+                    'UPDATE messages SET uid=-1 WHERE folder_id=' + FOLDER_ID + ' AND uid=?',
+                    (account, folder, uid),
+                )
@@ -0,0 +1,93 @@
+"""Parser/dispatcher throughput benchmark
+
+Not collected by pytest, run as::
+
+    python -m tests.bench_proto [max_lines]
+
+Feeds growing amounts of untagged FETCH lines through Proto in socket-sized
+chunks and reports the per-line cost, which must stay flat as the response
+grows. Then reports throughput on header-heavy `Folder.info` responses shaped
+after Gmail output.
+"""
+
+import sys
+import time
+
+from norless.imap_client import BUFSIZE, Proto
+
+
+def make_response(count: int) -> bytes:
+    lines = [b'* %d FETCH (UID %d FLAGS (\\Seen))\r\n' % (i, i) for i in range(1, count + 1)]
+    lines.append(b'A0 OK FETCH completed\r\n')
+    return b''.join(lines)
+
+
+def make_info_response(count: int) -> bytes:
+    """UID FETCH of message headers as Gmail sends them"""
+    flags = [b'(\\Seen)', b'()', b'(\\Seen \\Flagged)', b'($NotJunk \\Seen NotJunk)']
+    parts = []
+    for i in range(1, count + 1):
+        header = (
+            b'Message-ID: <CAF%dxq=GmX1n2B@mail.gmail.com>\r\n'
+            b'Date: Mon, 12 Aug 2024 10:%02d:11 +0000\r\n'
+            b'From: "Some Sender" <sender%d@example.com>\r\n'
+            b'To: user@gmail.com\r\n'
+            b'Subject: =?UTF-8?B?UmU6IFtwcm9qZWN0XSBVcGRhdGUgb24gdGhlIHRoaW5n?=\r\n'
+            b'\r\n'
+        ) % (i, i % 60, i)
+        parts.append(
+            b'* %d FETCH (X-GM-MSGID 17%015d UID %d FLAGS %s '
+            b'BODY[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)] {%d}\r\n'
+            % (i, i, i + 1000, flags[i % len(flags)], len(header))
+        )
+        parts.append(header)
+        parts.append(b')\r\n')
+    parts.append(b'A0 OK Success\r\n')
+    return b''.join(parts)
+
+
+def run(count: int, data: bytes | None = None) -> float:
+    data = data or make_response(count)
+    p = Proto()
+    p.command('FETCH', (b'1:*', b'(UID FLAGS)'))
+
+    start = time.perf_counter()
+    resp = None
+    for pos in range(0, len(data), BUFSIZE):
+        resp = p.wait_response(data[pos : pos + BUFSIZE])
+    duration = time.perf_counter() - start
+
+    assert resp is not None and len(resp.data) == count
+    return duration
+
+
+def main() -> None:
+    max_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    counts = []
+    count = 10_000
+    while count <= max_lines:
+        counts.append(count)
+        count *= 10
+
+    per_line = []
+    for count in counts:
+        duration = run(count)
+        per_line.append(duration / count)
+        print(f'{count:>10} lines {duration:8.3f}s {duration / count * 1e9:8.0f}ns/line')
+
+    ratio = per_line[-1] / per_line[0]
+    print(f'per-line cost ratio {counts[-1]}/{counts[0]}: {ratio:.2f}')
+    if ratio > 2:
+        sys.exit('non-linear scaling')
+
+    count = 50_000
+    data = make_info_response(count)
+    duration = run(count, data)
+    print(
+        f'header FETCH: {count / duration:8.0f} items/s'
+        f' {len(data) / duration / 1e6:6.1f} MB/s {duration / count * 1e6:6.1f}us/item'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Receive path benchmark
+
+Not collected by pytest, run as::
+
+    python -m tests.bench_recv [megabytes]
+
+Streams FETCH responses with large literals through Client over an
+in-memory socket and reports throughput and peak memory allocated while
+parsing relative to the message size, i.e. how many copies of a literal
+are alive at once.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from norless.imap_client import BUFSIZE, Client
+
+MESSAGE_SIZE = 256 * 1024
+
+
+class MemorySocket:
+    def __init__(self, data: bytes) -> None:
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def recv(self, size: int) -> bytes:
+        chunk = bytes(self._data[self._pos : self._pos + size])
+        self._pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buf: bytearray | memoryview, size: int = 0) -> int:
+        size = min(size or len(buf), len(self._data) - self._pos)
+        buf[:size] = self._data[self._pos : self._pos + size]
+        self._pos += size
+        return size
+
+    def sendall(self, data: bytes) -> None:
+        pass
+
+
+def make_stream(count: int) -> bytes:
+    body = (b'x' * 77 + b'\r\n') * (MESSAGE_SIZE // 79)
+    parts = [b'* OK hi\r\n']
+    for i in range(1, count + 1):
+        parts.append(b'* %d FETCH (UID %d FLAGS () BODY[] {%d}\r\n' % (i, i, len(body)))
+        parts.append(body)
+        parts.append(b')\r\n')
+    parts.append(b'A0 OK FETCH completed\r\n')
+    return b''.join(parts)
+
+
+def run(megabytes: int, trace: bool = False) -> float:
+    """Returns MB/s or, with trace set, peak allocated bytes"""
+    data = make_stream(megabytes * 1024 * 1024 // MESSAGE_SIZE)
+    client = Client(MemorySocket(data))  # type: ignore[arg-type]
+
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    total = 0
+    for item in client.fetch_iter(b'1:*', b'(UID FLAGS BODY[])'):
+        total += len(item['BODY'])
+    duration = time.perf_counter() - start
+
+    mb = total / (1024 * 1024)
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+    return mb / duration
+
+
+def main() -> None:
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    speed = run(megabytes)
+    peak = run(megabytes, trace=True)
+    print(f'{megabytes} MB in {BUFSIZE // 1024} KiB chunks')
+    print(f'throughput {speed:8.1f} MB/s')
+    print(f'peak allocated {peak / 1024:8.1f} KiB, {peak / MESSAGE_SIZE:.1f}x message size')
+
+
+if __name__ == '__main__':
+    main()
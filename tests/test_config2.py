@@ -1,5 +1,5 @@
 from norless.config_model import Config, XOAuth2Config
-from norless.schema import parse, ValidationError
+from norless.schema import ValidationError, parse
 
 
 def test_maildir_path_defaults_to_name() -> None:
@@ -74,3 +74,40 @@ def test_user_is_required() -> None:
         assert e.path == 'account.user'
     else:
         raise AssertionError('expected ValidationError')
+
+
+def test_maildir_fsync_mode_is_validated() -> None:
+    data = {
+        'state_dir': '/tmp/state',
+        'maildir': [{'name': 'inbox'}, {'name': 'archive', 'fsync': 'group'}],
+        'account': [],
+    }
+    result = parse(Config, data)
+    assert [it.fsync for it in result.maildirs] == ['none', 'group']
+
+    data['maildir'] = [{'name': 'inbox', 'fsync': 'always'}]
+    try:
+        parse(Config, data)
+    except ValidationError as e:
+        assert e.path == 'maildir.fsync'
+    else:
+        raise AssertionError('expected ValidationError')
+
+
+def test_account_connections_are_validated() -> None:
+    account = {
+        'name': 'home',
+        'from': 'user@example.com',
+        'host': 'imap.example.com',
+        'smtp_host': 'smtp.example.com',
+        'user': 'user',
+        'folders': {'INBOX': 'inbox'},
+        'connections': 0,
+    }
+    data = {'state_dir': '/tmp/state', 'maildir': [{'name': 'inbox'}], 'account': [account]}
+    try:
+        parse(Config, data)
+    except ValidationError as e:
+        assert e.path == 'account.connections'
+    else:
+        raise AssertionError('expected ValidationError')
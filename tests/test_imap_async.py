@@ -0,0 +1,80 @@
+import asyncio
+
+from norless.imap_async import AsyncClient
+
+
+class FakeWriter:
+    def __init__(self) -> None:
+        self.sent: list[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self.sent.append(data)
+
+    async def drain(self) -> None:
+        pass
+
+
+async def make_client(chunks: list[bytes]) -> tuple[AsyncClient, FakeWriter]:
+    reader = asyncio.StreamReader()
+    reader.feed_data(chunks[0])
+    writer = FakeWriter()
+    client = AsyncClient(reader, writer)  # type: ignore[arg-type]
+    await client._wait_response(b'*')
+
+    # the rest is read only after commands are sent
+    for chunk in chunks[1:]:
+        reader.feed_data(chunk)
+    return client, writer
+
+
+def test_async_client_select_search_pipelines_commands():
+    async def main():
+        client, writer = await make_client(
+            [
+                b'* OK hi\r\n',
+                (
+                    b'* FLAGS (\\Seen)\r\n* 3 EXISTS\r\n* 0 RECENT\r\n'
+                    b'* OK [UIDVALIDITY 7] ok\r\n* OK [UIDNEXT 5] ok\r\n'
+                    b'A0 OK [READ-WRITE] SELECT completed\r\n'
+                ),
+                b'* SEARCH 3 4\r\nA1 OK SEARCH completed\r\n',
+            ]
+        )
+        select, uids = await client.select_search(b'INBOX', b'(UID 3:*)', uid=True)
+        assert writer.sent == [b'A0 SELECT "INBOX"\r\n', b'A1 UID SEARCH (UID 3:*)\r\n']
+        assert (select.exists, select.uidvalidity, select.uidnext) == (3, 7, 5)
+        assert uids == [3, 4]
+
+    asyncio.run(main())
+
+
+def test_async_client_fetch_many_keeps_commands_in_flight():
+    async def main():
+        client, writer = await make_client(
+            [
+                b'* OK hi\r\n',
+                b'* 1 FETCH (UID 10)\r\nA0 OK done\r\n* 2 FETCH (UID 11)\r\n',
+                b'A1 OK done\r\n',
+                b'* 3 FETCH (UID 12)\r\nA2 OK done\r\n',
+            ]
+        )
+        result = [
+            it async for it in client.fetch_many([b'10', b'11', b'12'], b'(UID)', True, depth=2)
+        ]
+        assert result == [{'UID': b'10'}, {'UID': b'11'}, {'UID': b'12'}]
+        assert writer.sent[:2] == [b'A0 UID FETCH 10 (UID)\r\n', b'A1 UID FETCH 11 (UID)\r\n']
+        assert writer.sent[2] == b'A2 UID FETCH 12 (UID)\r\n'
+
+    asyncio.run(main())
+
+
+def test_async_client_times_out_on_a_stalled_server():
+    import pytest
+
+    async def main():
+        client, _ = await make_client([b'* OK hi\r\n'])
+        client.timeout = 0.01
+        with pytest.raises(TimeoutError):
+            await client.command('NOOP')
+
+    asyncio.run(main())
@@ -1,19 +1,34 @@
 import pytest
 from sansproto import Collector
-from norless.imap_client import Proto, Response, Select, Status, proto
+
+from norless.imap_client import ESearch, Proto, Response, Select, Status, proto
 
 
 class FakeSocket:
-    def __init__(self, chunks: list[bytes]):
+    def __init__(self, chunks: list[bytes | Exception]):
         self._chunks = iter(chunks)
         self.sent: list[bytes] = []
 
     def recv(self, size: int) -> bytes:
-        return next(self._chunks)
+        chunk = next(self._chunks)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def recv_into(self, buf: bytearray) -> int:
+        chunk = self.recv(len(buf))
+        buf[: len(chunk)] = chunk
+        return len(chunk)
 
     def sendall(self, data: bytes) -> None:
         self.sent.append(data)
 
+    def gettimeout(self) -> float | None:
+        return None
+
+    def settimeout(self, timeout: float | None) -> None:
+        pass
+
 
 def test_literals():
     c = Collector(proto)
@@ -101,7 +116,7 @@ def test_wait_response_returns_continuation_after_untagged_data():
     p = Proto()
     assert p.command('AUTHENTICATE', (b'XOAUTH2',)) == b'A0 AUTHENTICATE XOAUTH2\r\n'
 
-    assert p.wait_response(b'* 1 EXISTS\r\n+ \r\n', b'+', status=False) == Response(
+    assert p.wait_response(b'* 1 EXISTS\r\n+ \r\n', b'+') == Response(
         [[b'*', b'1', b'EXISTS']],
         Status(b'+', b'', b'', b'', b''),
     )
@@ -112,7 +127,7 @@ def test_wait_response_raises_on_current_tagged_failure_while_waiting_continuati
     p.command('AUTHENTICATE', (b'XOAUTH2',))
 
     with pytest.raises(ValueError, match='auth failed'):
-        p.wait_response(b'A0 NO auth failed\r\n', b'+', status=False)
+        p.wait_response(b'A0 NO auth failed\r\n', b'+')
 
 
 def test_wait_response_keeps_untagged_no_as_collected_response():
@@ -177,7 +192,9 @@ def test_collect_search_ignores_unrelated_untagged_data():
 
 def test_collect_fetch_header_fields_response():
     p = Proto()
-    p.command('UID FETCH', (b'1', b'(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'))
+    p.command(
+        'UID FETCH', (b'1', b'(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])')
+    )
     response = p.wait_response(
         b'* 1 FETCH (UID 123 BODY[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)] {5}\r\n'
         b'hello)\r\n'
@@ -198,10 +215,7 @@ def test_collect_fetch_multiple_body_sections_response():
     p = Proto()
     p.command('UID FETCH', (b'1', b'(BODY.PEEK[HEADER] BODY.PEEK[TEXT])'))
     response = p.wait_response(
-        b'* 1 FETCH (BODY[HEADER] {3}\r\n'
-        b'hdr BODY[TEXT] {4}\r\n'
-        b'text)\r\n'
-        b'A0 OK FETCH completed\r\n'
+        b'* 1 FETCH (BODY[HEADER] {3}\r\nhdr BODY[TEXT] {4}\r\ntext)\r\nA0 OK FETCH completed\r\n'
     )
 
     assert response is not None
@@ -281,10 +295,12 @@ def test_collect_select_readonly():
 def test_client_login_quotes_credentials():
     from norless.imap_client import Client
 
-    sock = FakeSocket([
-        b'* OK hi\r\n',
-        b'A0 OK LOGIN completed\r\n',
-    ])
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'A0 OK LOGIN completed\r\n',
+        ]
+    )
     client = Client(sock)  # type: ignore[arg-type]
 
     client.login(b'user"name', b'pa\\ss')
@@ -295,12 +311,440 @@ def test_client_login_quotes_credentials():
 def test_client_uid_store_collects_fetch_updates():
     from norless.imap_client import Client
 
-    sock = FakeSocket([
-        b'* OK hi\r\n',
-        b'* 1 FETCH (UID 123 FLAGS (\\Seen))\r\nA0 OK STORE completed\r\n',
-    ])
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* 1 FETCH (UID 123 FLAGS (\\Seen))\r\nA0 OK STORE completed\r\n',
+        ]
+    )
     client = Client(sock)  # type: ignore[arg-type]
 
     result = client.store(b'123', b'+FLAGS', b'(\\Seen)', uid=True)
 
     assert result == [{'UID': b'123', 'FLAGS': [b'\\Seen']}]
+
+
+def test_stream_response_returns_untagged_lines_before_completion():
+    p = Proto()
+    p.command('FETCH', (b'1:2', b'(UID)'))
+
+    assert p.stream_response(b'* 1 FETCH (UID 10)\r\n* 2 FE') == (
+        [[b'*', b'1', b'FETCH', [b'UID', b'10']]],
+        None,
+    )
+    assert p.stream_response(b'TCH (UID 11)\r\nA0 OK done\r\n') == (
+        [[b'*', b'2', b'FETCH', [b'UID', b'11']]],
+        Status(b'A0', b'OK', b'', b'', b'done'),
+    )
+
+
+def test_client_fetch_iter_yields_items_as_they_arrive():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* 1 FETCH (UID 10 BODY[] {3}\r\nfoo)\r\n',
+            b'* 2 FETCH (UID 11 BODY[] {3}\r\nbar)\r\nA0 OK FETCH completed\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    it = client.fetch_iter(b'10:11', b'(UID BODY.PEEK[])', uid=True)
+    assert next(it) == {'UID': b'10', 'BODY[]': b'foo', 'BODY': b'foo'}
+    assert sock.sent == [b'A0 UID FETCH 10:11 (UID BODY.PEEK[])\r\n']
+    assert next(it) == {'UID': b'11', 'BODY[]': b'bar', 'BODY': b'bar'}
+    assert list(it) == []
+
+
+def test_client_fetch_iter_drains_response_when_abandoned():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* 1 FETCH (UID 10)\r\n',
+            b'* 2 FETCH (UID 11)\r\nA0 OK FETCH completed\r\n',
+            b'A1 OK LOGIN completed\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    it = client.fetch_iter(b'10:11', b'(UID)', uid=True)
+    assert next(it) == {'UID': b'10'}
+    it.close()
+
+    client.login(b'user', b'pass')
+    assert sock.sent[-1] == b'A1 LOGIN "user" "pass"\r\n'
+
+
+def test_wait_response_keeps_lines_after_completion_for_next_command():
+    p = Proto()
+    p.command('NOOP', ())
+    assert p.wait_response(b'* 1 EXISTS\r\nA0 OK done\r\n* 2 EXI') == Response(
+        [[b'*', b'1', b'EXISTS']],
+        Status(b'A0', b'OK', b'', b'', b'done'),
+    )
+
+    p.command('NOOP', ())
+    assert p.wait_response(b'STS\r\n') is None
+    assert p.wait_response(b'A1 OK done\r\n') == Response(
+        [[b'*', b'2', b'EXISTS']],
+        Status(b'A1', b'OK', b'', b'', b'done'),
+    )
+
+
+def test_client_pipeline_matches_responses_by_tag():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            (
+                b'* FLAGS (\\Seen)\r\n* OK [UIDVALIDITY 2] ok\r\n* 1 EXISTS\r\n* 0 RECENT\r\n'
+                b'* OK [UIDNEXT 3] ok\r\nA0 OK [READ-WRITE] SELECT completed\r\n* SEARCH 1 2\r\n'
+            ),
+            b'A1 OK SEARCH completed\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    select, uids = client.select_search(b'INBOX', b'(UID 1:*)', uid=True)
+
+    assert sock.sent == [b'A0 SELECT "INBOX"\r\n', b'A1 UID SEARCH (UID 1:*)\r\n']
+    assert select.uidnext == 3
+    assert uids == [1, 2]
+
+
+def test_client_pipeline_waits_for_the_rest_when_a_command_fails():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'A0 BAD invalid sequence\r\n',
+            b'* 2 FETCH (UID 2)\r\n',
+            b'A1 OK done\r\n',
+            b'* 3 FETCH (UID 3)\r\nA2 OK done\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    with pytest.raises(ValueError):
+        client.pipeline([('FETCH', (b'x', b'(UID)')), ('FETCH', (b'2', b'(UID)'))])
+
+    assert list(client.fetch_iter(b'3', b'(UID)')) == [{'UID': b'3'}]
+
+
+def test_client_result_returns_already_received_response():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* 1 EXISTS\r\nA0 OK done\r\n* 2 EXISTS\r\nA1 OK done\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    t0 = client.queue('NOOP')
+    t1 = client.queue('NOOP')
+
+    assert client.result(t1).data == [[b'*', b'2', b'EXISTS']]
+    assert client.result(t0).data == [[b'*', b'1', b'EXISTS']]
+
+
+def test_client_fetch_many_keeps_commands_in_flight():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* 1 FETCH (UID 10)\r\nA0 OK done\r\n* 2 FETCH (UID 11)\r\n',
+            b'A1 OK done\r\n',
+            b'* 3 FETCH (UID 12)\r\nA2 OK done\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    result = client.fetch_many([b'10', b'11', b'12'], b'(UID)', uid=True, depth=2)
+    assert next(result) == {'UID': b'10'}
+    assert sock.sent == [b'A0 UID FETCH 10 (UID)\r\n', b'A1 UID FETCH 11 (UID)\r\n']
+    assert list(result) == [{'UID': b'11'}, {'UID': b'12'}]
+    assert sock.sent[-1] == b'A2 UID FETCH 12 (UID)\r\n'
+
+
+def test_client_fetch_many_waits_for_the_rest_when_a_fetch_fails():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'A0 NO no such message\r\n',
+            b'* 2 FETCH (UID 11)\r\n',
+            b'A1 OK done\r\n',
+            b'* 3 FETCH (UID 12)\r\nA2 OK done\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    with pytest.raises(ValueError):
+        list(client.fetch_many([b'10', b'11'], b'(UID)', uid=True, depth=2))
+
+    assert list(client.fetch_iter(b'12', b'(UID)')) == [{'UID': b'12'}]
+
+
+def test_client_capabilities_are_refreshed_after_login():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* CAPABILITY IMAP4rev1 LOGINDISABLED\r\nA0 OK done\r\n',
+            b'A1 OK LOGIN completed\r\n',
+            b'* CAPABILITY IMAP4rev1 IDLE\r\nA2 OK done\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    assert client.capabilities() == {b'IMAP4REV1', b'LOGINDISABLED'}
+    assert not client.has_capability(b'idle')
+    client.login(b'user', b'pass')
+    assert client.has_capability(b'idle')
+    assert client.has_capability(b'IDLE')
+    assert len(sock.sent) == 3
+
+
+def test_client_idle_returns_untagged_updates():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'+ idling\r\n',
+            b'* 4 EXI',
+            b'STS\r\n',
+            b'* 1 RECENT\r\nA0 OK IDLE terminated\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    assert client.idle() == [[b'*', b'4', b'EXISTS'], [b'*', b'1', b'RECENT']]
+    assert sock.sent == [b'A0 IDLE\r\n', b'DONE\r\n']
+
+
+def test_client_idle_stops_on_timeout():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'+ idling\r\n',
+            TimeoutError(),
+            b'A0 OK IDLE terminated\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    assert client.idle(timeout=10) == []
+    assert sock.sent == [b'A0 IDLE\r\n', b'DONE\r\n']
+
+
+def test_client_idle_stops_on_wakeup():
+    import os
+
+    from norless.imap_client import Client
+
+    idle_fd, _ = os.pipe()
+    wakeup, signal = os.pipe()
+
+    class IdleSocket(FakeSocket):
+        def fileno(self) -> int:
+            return idle_fd
+
+    sock = IdleSocket(
+        [
+            b'* OK hi\r\n',
+            b'+ idling\r\n',
+            b'A0 OK IDLE terminated\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    os.write(signal, b'.')
+    assert client.idle(timeout=10, wakeup=wakeup) == []
+    assert sock.sent == [b'A0 IDLE\r\n', b'DONE\r\n']
+
+
+def test_client_fetch_changed_collects_flags_and_vanished_uids():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            (
+                b'* VANISHED (EARLIER) 3:4,7\r\n'
+                b'* 1 FETCH (UID 5 FLAGS (\\Seen) MODSEQ (12))\r\n'
+                b'A0 OK FETCH completed\r\n'
+            ),
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    items, vanished = client.fetch_changed(b'1:*', b'(UID FLAGS)', 10, vanished=True)
+
+    assert sock.sent == [b'A0 UID FETCH 1:* (UID FLAGS) (CHANGEDSINCE 10 VANISHED)\r\n']
+    assert items == [{'UID': b'5', 'FLAGS': [b'\\Seen'], 'MODSEQ': [b'12']}]
+    assert vanished == [3, 4, 7]
+
+
+def test_client_compress_deflates_traffic():
+    import zlib
+
+    from norless.imap_client import Client
+
+    server = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    def deflate(data: bytes) -> bytes:
+        return server.compress(data) + server.flush(zlib.Z_SYNC_FLUSH)
+
+    body = b'Subject: hello\r\n\r\n' + b'hello world\r\n' * 1000
+    response = deflate(
+        b'* 1 FETCH (UID 10 BODY[] {%d}\r\n%s)\r\nA1 OK FETCH completed\r\n' % (len(body), body)
+    )
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'A0 OK DEFLATE active\r\n',
+            response[:1],
+            response[1:],
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+    client.compress()
+
+    assert client.fetch(b'10', b'(UID BODY.PEEK[])', uid=True) == [
+        {'UID': b'10', 'BODY[]': body, 'BODY': body}
+    ]
+    assert sock.sent[0] == b'A0 COMPRESS DEFLATE\r\n'
+    inflate = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    assert inflate.decompress(sock.sent[1]) == b'A1 UID FETCH 10 (UID BODY.PEEK[])\r\n'
+    assert client.wire_received < client.received / 10
+
+
+def test_collect_esearch_result():
+    p = Proto()
+    p.command('UID SEARCH', (b'RETURN (ALL MIN MAX COUNT)', b'(UID 1:*)'))
+    response = p.wait_response(
+        b'* ESEARCH (TAG "A0") UID MIN 2 MAX 47 COUNT 5 ALL 2,10:12,47\r\n'
+        b'A0 OK SEARCH completed\r\n'
+    )
+
+    assert response is not None
+    assert p.collect_esearch(response) == [
+        ESearch(min=2, max=47, count=5, all=b'2,10:12,47', uid=True)
+    ]
+    assert p.collect_search(response) == [2, 10, 11, 12, 47]
+
+
+def test_client_search_with_esearch():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            b'* ESEARCH (TAG "A0") UID ALL 5:7\r\nA0 OK SEARCH completed\r\n',
+            b'A1 OK SEARCH completed\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    assert client.search(b'(UID 5:*)', uid=True, esearch=True) == [5, 6, 7]
+    assert sock.sent == [b'A0 UID SEARCH RETURN (ALL) (UID 5:*)\r\n']
+    assert client.esearch(b'(UID 100:*)', uid=True) == ESearch(count=0, uid=True)
+
+
+def test_client_status_pipelines_mailboxes():
+    from norless.imap_client import Client
+
+    sock = FakeSocket(
+        [
+            b'* OK hi\r\n',
+            (
+                b'* STATUS "INBOX" (MESSAGES 231 UIDNEXT 44292)\r\nA0 OK STATUS completed\r\n'
+                b'* STATUS {4}\r\nSent (MESSAGES 2 UIDNEXT 3)\r\n'
+            ),
+            b'A1 OK STATUS completed\r\n',
+        ]
+    )
+    client = Client(sock)  # type: ignore[arg-type]
+
+    result = client.status([b'INBOX', b'Sent'], b'(MESSAGES UIDNEXT)')
+
+    assert sock.sent == [
+        b'A0 STATUS "INBOX" (MESSAGES UIDNEXT)\r\n',
+        b'A1 STATUS "Sent" (MESSAGES UIDNEXT)\r\n',
+    ]
+    assert result == [{'MESSAGES': 231, 'UIDNEXT': 44292}, {'MESSAGES': 2, 'UIDNEXT': 3}]
+
+
+def test_proto_streams_large_literals_into_sink():
+    class Sink:
+        def __init__(self) -> None:
+            self.chunks: list[bytes] = []
+            self.closed = False
+
+        def write(self, data: bytes) -> None:
+            self.chunks.append(data)
+
+        def close(self) -> None:
+            self.closed = True
+
+    sinks: list[Sink] = []
+
+    def spool(size: int) -> Sink | None:
+        if size < 5:
+            return None
+        sinks.append(Sink())
+        return sinks[-1]
+
+    c = Collector(proto, spool)
+    assert c.send(b'* 1 FETCH (UID 7 FLAGS {2}\r\n') == []
+    assert c.send(b'ab BODY[] {10}\r\n0123') == []
+    assert c.send(b'456') == []
+    result = c.send(b'789)\r\n')
+
+    assert result == [[b'*', b'1', b'FETCH', [b'UID', b'7', b'FLAGS', b'ab', b'BODY[]', sinks[0]]]]
+    assert sinks[0].chunks == [b'0123', b'456', b'789']
+    assert sinks[0].closed
+
+
+def test_proto_tokens():
+    c = Collector(proto)
+
+    result = c.send(
+        b'* 3 FETCH (UID 9 FLAGS (\\Seen $Label) X-GM-LABELS ("\\\\Important" "a \\"b\\" (c)" NIL) '
+        b'BODY[HEADER.FIELDS (MESSAGE-ID DATE)] {3}\r\nabc BODY[]<0> {0}\r\n)\r\n'
+    )
+    assert result == [
+        [
+            b'*',
+            b'3',
+            b'FETCH',
+            [
+                b'UID',
+                b'9',
+                b'FLAGS',
+                [b'\\Seen', b'$Label'],
+                b'X-GM-LABELS',
+                [b'\\Important', b'a "b" (c)', b'NIL'],
+                b'BODY[HEADER.FIELDS ( MESSAGE-ID DATE ) ]',
+                b'abc',
+                b'BODY[]<0>',
+                b'',
+            ],
+        ]
+    ]
+
+    result = c.send(b'* LIST (\\HasNoChildren) "/" "[Gmail]/All Mail"\r\n')
+    assert result == [[b'*', b'LIST', [b'\\HasNoChildren'], b'/', b'[Gmail]/All Mail']]
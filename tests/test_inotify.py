@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from norless.maildir import Maildir
+
+
+def make_watcher(maildirs):
+    from norless.inotify import MaildirWatcher
+
+    try:
+        return MaildirWatcher(maildirs)
+    except OSError:
+        pytest.skip('inotify is not available')
+
+
+def test_watcher_applies_changes_of_other_programs(tmp_path):
+    md = Maildir(str(tmp_path / 'inbox'))
+    trash = Maildir(str(tmp_path / 'trash'))
+    key = md.add(b'one')
+    watcher = make_watcher([md, trash])
+
+    # own changes are already in the toc
+    own = md.add(b'two')
+    md.set_flags(own, 'S')
+    assert watcher.read() == []
+
+    seen = os.path.join(md.path_cur, key + ':2,S')
+    os.rename(md.toc[key][0], seen)
+    changes = watcher.read()
+    assert [(it.kind, it.msgkey) for it in changes] == [('flags', key)]
+    assert md.toc[key] == (seen, '2,S')
+
+    os.rename(seen, os.path.join(trash.path_cur, key + ':2,S'))
+    changes = watcher.read()
+    assert {(it.maildir.path, it.kind, it.msgkey) for it in changes} == {
+        (md.path, 'removed', key),
+        (trash.path, 'added', key),
+    }
+    assert key not in md.toc
+    assert key in trash.toc
+
+    (tmp_path / 'inbox' / 'new' / 'delivered').write_bytes(b'three')
+    os.unlink(md.toc[own][0])
+    changes = watcher.read()
+    assert [(it.kind, it.msgkey) for it in changes] == [('added', 'delivered'), ('removed', own)]
+    assert set(md.toc) == {'delivered'}
+    watcher.close()
@@ -1,4 +1,6 @@
-from norless.maildir import Maildir
+import os
+
+from norless.maildir import Headers, Maildir, Message
 
 
 def test_dir_create(tmpdir):
@@ -138,3 +140,237 @@ def test_set_flags(tmpdir):
     assert md.get_flags(key) == 'S'
     md._invalidate()
     assert md.get_flags(key) == 'S'
+
+
+def test_spooled_message_is_committed_by_rename(tmp_path):
+    md = Maildir(str(tmp_path))
+    data = b'Message-ID: <1@example.com>\r\n\r\n' + b'x' * 100
+    tmp = md.spool()
+    tmp.write(data[:10])
+    tmp.write(data[10:])
+    tmp.close()
+
+    assert not md.toc
+    key = md.commit(tmp, 'S')
+    assert md[key].original_body == data
+    assert md.get_flags(key) == 'S'
+    assert tmp.hash() == Message(data).hash()
+    assert tmp.headers()['message-id'] == '<1@example.com>'
+    assert not os.listdir(md.path_tmp)
+
+
+def test_headers_match_email_parser():
+    samples = [
+        b'Message-ID: <1@example.com>\r\nSubject: one\r\n\r\nbody: text\r\n',
+        b'From alice Mon Jan  1 00:00:00 2024\nSubject:   folded\n  line\n\tnext\nTo: a\n\nX: y\n',
+        b'Subject: first\nsubject: second\nDate: today\nno header line\nFrom: late\n',
+        b'Subject: =?utf-8?q?caf=C3=A9?=\r\n \r\nTo: b\r\n\r\n',
+        b'Subject: caf\xc3\xa9\r\nFrom: x\r\n\r\n',
+        b': broken\nTo: c\r\rFrom: body\n',
+        b'Subject: no body',
+    ]
+    for data in samples:
+        headers = Headers(data)
+        msg = Message(data)
+        for name in ('message-id', 'date', 'from', 'to', 'subject', 'x'):
+            expected = msg[name]
+            assert headers[name] == (None if expected is None else str(expected)), (data, name)
+
+
+def test_get_headers_reads_header_block(tmp_path):
+    md = Maildir(str(tmp_path))
+    key = md.add(b'Message-ID: <2@example.com>\r\nTo: x\r\n\r\nMessage-ID: <body@example.com>\r\n')
+
+    headers = md.get_headers(key)
+    assert headers['message-id'] == '<2@example.com>'
+    assert headers.size == len(b'Message-ID: <2@example.com>\r\nTo: x\r\n\r\n')
+
+
+def test_toc_snapshot_rescans_changed_dirs_only(tmp_path, monkeypatch):
+    from norless import maildir
+
+    md = Maildir(str(tmp_path))
+    seen = md.add(b'seen', 'S')
+    unseen = md.add(b'unseen')
+
+    def age(*names):
+        for name in names:
+            os.utime(tmp_path / name, ns=(0, os.stat(tmp_path / name).st_mtime_ns - 10**10))
+
+    # recently modified directories are not trusted
+    age('cur')
+    assert set(Maildir(str(tmp_path)).toc) == {seen, unseen}
+
+    scanned = []
+    scan_dir = maildir.scan_dir
+    monkeypatch.setattr(maildir, 'scan_dir', lambda path: scanned.append(path) or scan_dir(path))
+    assert set(Maildir(str(tmp_path)).toc) == {seen, unseen}
+    assert scanned == [md.path_new]
+
+    age('new')
+    assert set(Maildir(str(tmp_path)).toc) == {seen, unseen}
+    scanned.clear()
+    assert set(Maildir(str(tmp_path)).toc) == {seen, unseen}
+    assert scanned == []
+
+    os.rename(md.toc[unseen][0], os.path.join(md.path_cur, unseen + ':2,S'))
+    age('new', 'cur')
+    toc = Maildir(str(tmp_path)).toc
+    assert toc[unseen] == (os.path.join(md.path_cur, unseen + ':2,S'), '2,S')
+    assert scanned == [md.path_new, md.path_cur]
+
+
+def test_group_fsync_flushes_before_state_commit(tmp_path, monkeypatch):
+    from norless import maildir
+
+    flushed = []
+    monkeypatch.setattr(maildir, 'syncfs', lambda path: flushed.append(path) or False)
+    monkeypatch.setattr(maildir, 'fsync_path', flushed.append)
+
+    md = Maildir(str(tmp_path), fsync='group')
+    state = md.state
+    with state.batch():
+        first = md.add(b'one')
+        tmp = md.spool()
+        tmp.write(b'two')
+        second = md.commit(tmp, 'S')
+        state.put_message(first, 'acc', 'INBOX', 1, '<1>', 'h1')
+        state.put_message(second, 'acc', 'INBOX', 2, '<2>', 'h2')
+        assert flushed == []
+
+    assert flushed == [md.toc[first][0], md.toc[second][0], md.path_new, md.path_cur]
+
+    flushed.clear()
+    state.set_folder('acc', 'INBOX', 1)
+    assert flushed == []
+
+
+def test_concurrent_flush_waits_for_the_one_in_progress(tmp_path, monkeypatch):
+    import threading
+
+    from norless import maildir
+
+    started = threading.Event()
+    release = threading.Event()
+    flushed = []
+
+    def slow_fsync(path):
+        started.set()
+        release.wait(5)
+        flushed.append(path)
+
+    monkeypatch.setattr(maildir, 'fsync_path', slow_fsync)
+
+    md = Maildir(str(tmp_path), fsync='group')
+    md.add(b'one')
+    first = threading.Thread(target=md.flush_messages)
+    first.start()
+    started.wait(5)
+
+    # the other thread's keys were taken by the first flush and are not durable yet
+    second = threading.Thread(target=md.flush_messages)
+    second.start()
+    second.join(0.2)
+    assert second.is_alive()
+
+    release.set()
+    first.join()
+    second.join()
+    assert len(flushed) == 3
+
+
+def test_syncfs_mode_flushes_the_filesystem(tmp_path, monkeypatch):
+    from norless import maildir
+
+    flushed = []
+    available = [True]
+    monkeypatch.setattr(maildir, 'syncfs', lambda path: flushed.append(path) or available[0])
+    monkeypatch.setattr(maildir, 'fsync_path', flushed.append)
+
+    md = Maildir(str(tmp_path), fsync='syncfs')
+    md.add(b'one')
+    md.flush_messages()
+    assert flushed == [str(tmp_path)]
+
+    # files are synced one by one where syncfs(2) is missing
+    flushed.clear()
+    available[0] = False
+    key = md.add(b'two')
+    md.flush_messages()
+    assert flushed == [str(tmp_path), md.toc[key][0], md.path_new, md.path_cur]
+
+
+def test_per_message_fsync(tmp_path, monkeypatch):
+    import pytest
+
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+
+    md = Maildir(str(tmp_path), fsync='per-message')
+    md.add(b'one')
+    assert len(synced) == 2  # file and new/
+
+    with pytest.raises(ValueError):
+        Maildir(str(tmp_path), fsync='always')
+
+
+def test_messages_are_written_outside_of_the_lock(tmp_path):
+    import threading
+
+    md = Maildir(str(tmp_path))
+    _ = md.toc
+    keys = []
+
+    def store(n):
+        tmp = md.spool()
+        tmp.write(b'message %d' % n)
+        tmp.close()
+        keys.append(md.add(b'added %d' % n))
+
+    with md.lock:
+        threads = [threading.Thread(target=store, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        # spooling is not blocked, toc updates are
+        while len(os.listdir(md.path_tmp)) < 8:
+            pass
+        assert not keys
+
+    for t in threads:
+        t.join()
+    assert len(set(keys)) == 8
+    assert set(keys) == set(md.toc)
+
+
+def test_compressed_messages(tmp_path):
+    import gzip
+    import lzma
+    from pathlib import Path
+
+    message = b'Message-ID: <1@example.com>\r\nSubject: test\r\n\r\n' + b'body line\r\n' * 1000
+    md = Maildir(str(tmp_path), compression='gzip')
+    added = md.add(message)
+    tmp = md.spool()
+    tmp.write(message[:100])
+    tmp.write(message[100:])
+    spooled = md.commit(tmp, 'S')
+
+    assert added.endswith('.gz') and spooled.endswith('.gz')
+    assert tmp.hash() == Message(message).hash() and tmp.size == len(message)
+    for key in (added, spooled):
+        path = md.toc[key][0]
+        assert os.path.getsize(path) < len(message) / 10
+        assert gzip.decompress(Path(path).read_bytes()) == message
+        assert md[key].original_body == message
+        assert md.get_headers(key)['message-id'] == '<1@example.com>'
+
+    # files of other modes stay readable
+    md.compression = 'xz'
+    packed = md.add(message)
+    assert packed.endswith('.xz')
+    assert lzma.decompress(Path(md.toc[packed][0]).read_bytes()) == message
+    md.compression = 'none'
+    plain = md.add(message)
+    assert Path(md.toc[plain][0]).read_bytes() == message
+    md._invalidate()
+    assert {md.get_bytes(it) for it in (added, spooled, packed, plain)} == {message}
@@ -0,0 +1,547 @@
+import os
+
+from norless import run
+from norless.config import NorlessConfig
+from norless.imap import Info, Status
+from norless.maildir import Message
+
+
+def make_message(n: int) -> bytes:
+    return b'Message-ID: <%d@example.com>\r\nSubject: test %d\r\n\r\nbody %d\r\n' % (n, n, n)
+
+
+class FakeFolder:
+    def __init__(self, box: 'FakeBox', name: str) -> None:
+        self.box = box
+        self.name = name
+
+    @property
+    def uidvalidity(self) -> int:
+        return self.box.uidvalidity
+
+    @property
+    def uidnext(self) -> int:
+        return max(self.box.messages, default=0) + 1
+
+    @property
+    def total(self) -> int:
+        return len(self.box.messages)
+
+    @property
+    def highestmodseq(self) -> int | None:
+        return None
+
+    def uids_since(self, last_uid: int) -> list[int]:
+        self.box.calls.append('uids_since')
+        return [uid for uid in self.box.messages if uid > last_uid]
+
+    def info(self, uids: list[int] | None = None) -> list[Info]:
+        result = []
+        for uid in uids or self.box.messages:
+            msg = Message(self.box.messages[uid])
+            result.append(Info(uid, run.message_id(msg), (), msg))
+        return result
+
+    def fetch_uids(self, uids: list[int], spool=None) -> list[dict[str, object]]:
+        self.box.calls.append('fetch_uids')
+        result = []
+        for uid in uids:
+            body = self.box.messages[uid]
+            sink = spool and spool(len(body))
+            if sink:
+                sink.write(body)
+                sink.close()
+            result.append({'uid': str(uid), 'flags': (), 'body': sink or body})
+        return result
+
+    def seen(self, uids: list[int]) -> None:
+        self.box.calls.append('seen')
+        self.box.seen.extend(uids)
+
+    def delete(self, uids: list[int]) -> None:
+        self.box.deleted.extend(uids)
+
+
+class FakeBox:
+    name = 'home'
+
+    def __init__(self, messages: dict[int, bytes], connections: int = 1) -> None:
+        self.messages = messages
+        self.uidvalidity = 1
+        self.calls: list[str] = []
+        self.deleted: list[int] = []
+        self.seen: list[int] = []
+        self.connections = connections
+        self.copies: list[FakeBox] = []
+        self.closed = 0
+
+    def copy(self) -> 'FakeBox':
+        box = FakeBox(self.messages)
+        box.calls = self.calls
+        self.copies.append(box)
+        return box
+
+    def get_folder(self, name: str) -> FakeFolder:
+        return FakeFolder(self, name)
+
+    def close(self) -> None:
+        self.closed += 1
+
+    def get_statuses(self, folders: list[str]) -> dict[str, Status]:
+        folder = self.get_folder(folders[0])
+        return {
+            name: Status(folder.total, 0, self.uidvalidity, None, folder.uidnext)
+            for name in folders
+        }
+
+
+def make_config(
+    tmp_path, box: FakeBox, folders: str = 'INBOX = "inbox"', extra: str = ''
+) -> NorlessConfig:
+    config_path = tmp_path / 'norless.toml'
+    config_path.write_text(
+        f"""
+state_dir = "{tmp_path}"
+{extra}
+trash_maildir = "trash"
+
+[[maildir]]
+name = "inbox"
+
+[[account]]
+name = "home"
+host = "imap.example.com"
+user = "alice"
+from = "alice@example.com"
+smtp_host = "smtp.example.com"
+
+[account.folders]
+{folders}
+""".strip()
+    )
+
+    config = NorlessConfig(str(config_path))
+    config.accounts['home'] = box  # type: ignore[assignment]
+    return config
+
+
+def test_sync_stores_new_messages_and_skips_unchanged_folder(tmp_path) -> None:
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert box.calls == ['uids_since', 'fetch_uids']
+    assert sorted(it.msgid for it in maildir.state.getall()) == [
+        '<1@example.com>',
+        '<2@example.com>',
+    ]
+
+    box.calls.clear()
+    run.sync_account_boxes(config, config.sync_list)
+    assert box.calls == []
+
+    box.messages[3] = make_message(3)
+    run.sync_account_boxes(config, config.sync_list)
+    assert box.calls == ['uids_since', 'fetch_uids']
+    assert len(maildir.toc) == 3
+
+
+def test_sync_deletes_messages_moved_to_trash(tmp_path) -> None:
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert config.trash_maildir_config is not None
+    trash = run.get_maildir(config, config.trash_maildir_config)
+    info = maildir.state.by_uid('home', 'INBOX', 2)
+    assert info is not None
+    trash.add(make_message(2))
+    maildir.discard(info.fname)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert box.deleted == [2]
+    assert not trash.toc
+
+
+def test_sync_spreads_folders_over_connections(tmp_path) -> None:
+    box = FakeBox({1: make_message(1)}, connections=2)
+    config = make_config(tmp_path, box, 'INBOX = "inbox"\nSent = "inbox"\nSpam = "inbox"')
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    for s in config.sync_list:
+        maildir.state.set_folder('home', s.folder, 1)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert len(box.copies) == 1
+    assert [it.closed for it in box.copies] == [1]
+    assert box.closed == 0
+    assert box.calls.count('uids_since') == 3
+    assert {it.folder for it in maildir.state.getall()} == {'INBOX', 'Sent', 'Spam'}
+
+
+class AsyncFakeFolder:
+    def __init__(self, folder: FakeFolder) -> None:
+        self.folder = folder
+
+    def __getattr__(self, name: str):
+        return getattr(self.folder, name)
+
+    async def uids_since(self, last_uid: int) -> list[int]:
+        return self.folder.uids_since(last_uid)
+
+    async def info(self, uids: list[int]):
+        for it in self.folder.info(uids):
+            yield it
+
+    async def fetch_uids(self, uids: list[int], spool=None):
+        for it in self.folder.fetch_uids(uids, spool):
+            yield it
+
+    async def seen(self, uids: list[int]) -> None:
+        self.folder.seen(uids)
+
+    async def delete(self, uids: list[int]) -> None:
+        self.folder.delete(uids)
+
+
+class AsyncFakeBox:
+    def __init__(self, box: FakeBox) -> None:
+        self.box = box
+        self.name = box.name
+        self.connections = box.connections
+        self.closed = 0
+
+    def copy(self) -> 'AsyncFakeBox':
+        return AsyncFakeBox(self.box.copy())
+
+    def get_folder(self, name: str) -> AsyncFakeFolder:
+        return AsyncFakeFolder(self.box.get_folder(name))
+
+    async def get_statuses(self, folders: list[str]) -> dict[str, Status]:
+        return self.box.get_statuses(folders)
+
+    async def close(self) -> None:
+        self.closed += 1
+
+
+def test_async_sync_stores_new_messages(tmp_path) -> None:
+    import asyncio
+
+    box = FakeBox({1: make_message(1), 2: make_message(2)}, connections=2)
+    config = make_config(tmp_path, box, 'INBOX = "inbox"\nSent = "inbox"')
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    for s in config.sync_list:
+        maildir.state.set_folder('home', s.folder, 1)
+
+    account = AsyncFakeBox(box)
+    asyncio.run(run.async_sync_account_boxes(config, config.sync_list, account))  # type: ignore[arg-type]
+
+    assert box.calls.count('fetch_uids') == 2
+    assert len(box.copies) == 1
+    assert account.closed == 1
+    assert {it.folder for it in maildir.state.getall()} == {'INBOX', 'Sent'}
+    assert len(maildir.toc) == 4
+
+    box.calls.clear()
+    asyncio.run(run.async_sync_account_boxes(config, config.sync_list, account))  # type: ignore[arg-type]
+    assert box.calls == []
+
+
+def test_async_sync_keeps_going_after_a_failed_account(tmp_path, monkeypatch) -> None:
+    import asyncio
+
+    config = make_config(tmp_path, FakeBox({}))
+    s = config.sync_list[0]
+    monkeypatch.setattr(config, 'sync_by_account', lambda: {'broken': [s], 'home': [s]})
+    synced = []
+
+    async def sync_boxes(config, sync_list, account=None):
+        if not synced:
+            synced.append('broken')
+            raise TimeoutError
+        await asyncio.sleep(0.01)
+        synced.append('home')
+
+    monkeypatch.setattr(run, 'async_sync_account_boxes', sync_boxes)
+    asyncio.run(run.async_sync(config))
+    assert synced == ['broken', 'home']
+
+
+def test_sync_spools_large_messages(tmp_path) -> None:
+    large = make_message(2) + b'x' * 1000 + b'\r\n'
+    box = FakeBox({1: make_message(1), 2: large})
+    config = make_config(tmp_path, box, extra='spool_threshold = 500')
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    info = maildir.state.by_uid('home', 'INBOX', 2)
+    assert info is not None
+    assert info.msgid == '<2@example.com>'
+    assert info.hash == Message(large).hash()
+    assert maildir[info.fname].original_body == large
+    assert not list((tmp_path / 'inbox' / 'tmp').iterdir())
+
+
+def test_collect_garbage_drops_stale_rows(tmp_path, monkeypatch) -> None:
+    config = make_config(tmp_path, FakeBox({}))
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    state = maildir.state
+    kept = maildir.add(make_message(1))
+    vanished = maildir.add(make_message(2))
+    state.put_message(kept, 'home', 'INBOX', 1, '<1@example.com>', 'h1')
+    state.put_message(vanished, 'home', 'INBOX', -1, '<2@example.com>', 'h2')
+    state.put_message('deleted', 'home', 'INBOX', 3, '<3@example.com>', 'h3')
+    state.put_message('trashed', 'home', 'INBOX', 4, '<4@example.com>', 'h4')
+
+    monkeypatch.setattr(run, 'GC_CHUNK', 1)
+    assert run.collect_garbage(maildir, {'<4@example.com>'}, limit=2) == 1
+    assert run.collect_garbage(maildir, {'<4@example.com>'}, limit=2) == 1
+    assert sorted(it.fname for it in state.getall()) == sorted([kept, 'trashed'])
+
+    assert run.collect_garbage(maildir, set()) == 1
+    assert [it.fname for it in state.getall()] == [kept]
+
+
+def test_push_local_changes(tmp_path) -> None:
+    from norless.inotify import Change
+
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert config.trash_maildir_config is not None
+    trash = run.get_maildir(config, config.trash_maildir_config)
+    s = config.sync_list[0]
+    folder = box.get_folder('INBOX')
+    first = maildir.state.by_uid('home', 'INBOX', 1)
+    second = maildir.state.by_uid('home', 'INBOX', 2)
+    assert first is not None and second is not None
+
+    maildir.set_flags(first.fname, 'S')
+    changes = [Change(maildir, 'flags', first.fname), Change(maildir, 'flags', second.fname)]
+    run.push_local_changes(config, maildir, s, folder, changes)  # type: ignore[arg-type]
+    assert box.seen == [1]
+    assert box.deleted == []
+
+    trashed = trash.add(make_message(2))
+    maildir.discard(second.fname)
+    run.push_local_changes(config, maildir, s, folder, [Change(trash, 'added', trashed)])  # type: ignore[arg-type]
+    assert box.deleted == [2]
+    assert not trash.toc
+
+
+def test_trash_index_parses_new_files_only(tmp_path, monkeypatch) -> None:
+    config = make_config(tmp_path, FakeBox({}))
+    assert config.trash_maildir_config is not None
+    trash = run.get_maildir(config, config.trash_maildir_config)
+    first = trash.add(make_message(1))
+    second = trash.add(make_message(2))
+
+    assert run.trash_index(config) == {'<1@example.com>': [first], '<2@example.com>': [second]}
+
+    parsed = []
+    get_headers = trash.get_headers
+    monkeypatch.setattr(trash, 'get_headers', lambda key: parsed.append(key) or get_headers(key))
+    third = trash.add(make_message(1))
+    trash.discard(second)
+
+    index = run.trash_index(config)
+    assert parsed == [third]
+    assert sorted(index['<1@example.com>']) == sorted([first, third])
+    assert '<2@example.com>' not in index
+    assert trash.state.trash_entries() == {first: '<1@example.com>', third: '<1@example.com>'}
+
+
+def test_sync_dedup_links_identical_messages(tmp_path) -> None:
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box, 'INBOX = "inbox"\n"All Mail" = "inbox"')
+    config.maildirs['inbox'].dedup = True
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    for s in config.sync_list:
+        maildir.state.set_folder('home', s.folder, 1)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert box.calls.count('fetch_uids') == 2
+    assert len(maildir.toc) == 4
+    first = maildir.state.by_uid('home', 'INBOX', 1)
+    assert first is not None
+    linked = [it.fname for it in maildir.state.by_hash(first.hash)]
+    assert len(linked) == 2
+    assert {os.stat(maildir.toc[it][0]).st_ino for it in linked} == {
+        os.stat(maildir.toc[first.fname][0]).st_ino
+    }
+
+    maildir.discard(linked[0])
+    assert maildir[linked[1]].original_body == make_message(1)
+
+
+def test_gc_keeps_high_water_uid_of_deleted_messages(tmp_path) -> None:
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    run.do_sync(config)
+
+    second = maildir.state.by_uid('home', 'INBOX', 2)
+    assert second is not None
+    maildir.discard(second.fname)
+    run.do_sync(config)
+
+    box.messages[3] = make_message(3)
+    run.do_sync(config)
+    msgids = {run.message_id(maildir.get_headers(it)) for it in maildir.toc}
+    assert msgids == {'<1@example.com>', '<3@example.com>'}
+
+
+def test_gc_keeps_high_water_uid_of_trashed_messages(tmp_path) -> None:
+    box = FakeBox({1: make_message(1), 2: make_message(2)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    run.do_sync(config)
+
+    assert config.trash_maildir_config is not None
+    trash = run.get_maildir(config, config.trash_maildir_config)
+    second = maildir.state.by_uid('home', 'INBOX', 2)
+    assert second is not None
+    trash.add(make_message(2))
+    maildir.discard(second.fname)
+    run.do_sync(config)
+    assert box.deleted == [2]
+    assert [it.uid for it in maildir.state.getall()] == [1]
+
+    # no expunge, the message is still on the server
+    box.messages[3] = make_message(3)
+    run.do_sync(config)
+    assert sorted(it.uid for it in maildir.state.getall()) == [1, 3]
+    assert len(maildir.toc) == 2
+
+
+def test_sync_dedup_keeps_writes_batched(tmp_path) -> None:
+    messages = {uid: make_message(uid % 10) for uid in range(1, 201)}
+    config = make_config(tmp_path, FakeBox(messages))
+    config.maildirs['inbox'].dedup = True
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    commits = []
+    maildir.state.before_commit = lambda: commits.append(1)
+
+    run.sync_account_boxes(config, config.sync_list)
+
+    assert len(commits) == 1
+    assert len(maildir.state.getall()) == 200
+    assert len({os.stat(path).st_ino for path, _ in maildir.toc.values()}) == 10
+
+
+def test_remote_flag_changes_keep_local_ones(tmp_path) -> None:
+    box = FakeBox({1: make_message(1)})
+    config = make_config(tmp_path, box)
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    run.sync_account_boxes(config, config.sync_list)
+
+    (fname,) = maildir.toc
+    maildir.set_flags(fname, 'S')
+
+    # flagged on another client, not seen there
+    s = config.sync_list[0]
+    run.apply_remote_flags(maildir, s, {1: ('\\Flagged',)}, [])
+    assert maildir.get_flags(fname) == 'FS'
+
+    run.apply_remote_flags(maildir, s, {1: ()}, [])
+    assert maildir.get_flags(fname) == 'S'
+
+    run.apply_remote_flags(maildir, s, {1: ('\\Seen',)}, [])
+    run.apply_remote_flags(maildir, s, {1: ()}, [])
+    assert maildir.get_flags(fname) == ''
+
+
+def test_idle_closes_broken_connections(tmp_path, monkeypatch) -> None:
+    import pytest
+
+    class Stop(BaseException):
+        pass
+
+    box = FakeBox({1: make_message(1)})
+    config = make_config(tmp_path, box)
+    run.get_maildir(config, config.maildirs['inbox']).state.set_folder('home', 'INBOX', 1)
+
+    def wait_changes(self, timeout=None, wakeup=None):
+        raise ConnectionError('connection lost')
+
+    def sleep(delay: float) -> None:
+        if len(box.copies) == 2:
+            raise Stop
+
+    monkeypatch.setattr(FakeFolder, 'wait_changes', wait_changes, raising=False)
+    monkeypatch.setattr(run.time, 'sleep', sleep)
+    with pytest.raises(Stop):
+        run.idle_account_box(config, config.sync_list[0])
+
+    assert [it.closed for it in box.copies] == [1, 1]
+
+
+def test_idle_collects_garbage_between_syncs(tmp_path, monkeypatch) -> None:
+    import pytest
+
+    class Stop(BaseException):
+        pass
+
+    box = FakeBox({1: make_message(1)})
+    config = make_config(tmp_path, box)
+    run.get_maildir(config, config.maildirs['inbox']).state.set_folder('home', 'INBOX', 1)
+    collected = []
+    waits: list[bool] = []
+
+    def wait_changes(self, timeout=None, wakeup=None):
+        if not waits:
+            raise Stop
+        return waits.pop()
+
+    monkeypatch.setattr(FakeFolder, 'wait_changes', wait_changes, raising=False)
+    monkeypatch.setattr(run, 'collect_garbage', lambda *args: collected.append(args[2]))
+    waits[:] = [True, True]
+    with pytest.raises(Stop):
+        run.idle_account_box(config, config.sync_list[0])
+    assert collected == [run.GC_AFTER_SYNC]
+
+    monkeypatch.setattr(run, 'IDLE_GC_INTERVAL', 0)
+    waits[:] = [True]
+    with pytest.raises(Stop):
+        run.idle_account_box(config, config.sync_list[0])
+    assert len(collected) == 3
+
+
+def test_failed_fetch_leaves_no_spooled_messages(tmp_path) -> None:
+    import pytest
+
+    large = make_message(2) + b'x' * 1000 + b'\r\n'
+    box = FakeBox({1: large, 2: large, 3: large})
+    config = make_config(tmp_path, box, extra='spool_threshold = 500')
+    maildir = run.get_maildir(config, config.maildirs['inbox'])
+    maildir.state.set_folder('home', 'INBOX', 1)
+    folder = box.get_folder('INBOX')
+
+    def fetch_uids(uids, spool=None):
+        yield from FakeFolder.fetch_uids(folder, uids[:1], spool)
+        sink = spool(len(large))
+        sink.write(large[:100])
+        raise ConnectionError('connection lost')
+
+    folder.fetch_uids = fetch_uids  # type: ignore[method-assign]
+    with pytest.raises(ConnectionError):
+        run.sync_remote_changes(maildir, config.sync_list[0], folder, config.spool_threshold)  # type: ignore[arg-type]
+
+    assert len(maildir.toc) == 1
+    assert not list((tmp_path / 'inbox' / 'tmp').iterdir())
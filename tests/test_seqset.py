@@ -0,0 +1,23 @@
+from norless import seqset
+
+
+def test_encode() -> None:
+    assert seqset.encode([]) == b''
+    assert seqset.encode([5]) == b'5'
+    assert seqset.encode([5002, 3, 1, 2, 3, 4, 5000, 4999]) == b'1:4,4999:5000,5002'
+    assert seqset.encode(range(1, 5001)) == b'1:5000'
+
+
+def test_decode() -> None:
+    assert seqset.decode(b'1,3:5,9:7') == [1, 3, 4, 5, 7, 8, 9]
+    assert seqset.decode(seqset.encode([1, 2, 3, 10, 12])) == [1, 2, 3, 10, 12]
+
+
+def test_split_keeps_sets_under_limit() -> None:
+    uids = list(range(1, 10000, 2))
+    parts = list(seqset.split(uids, limit=100))
+
+    assert all(len(it) <= 100 for it in parts)
+    assert [uid for it in parts for uid in seqset.decode(it)] == uids
+    assert list(seqset.split(range(1, 500001), limit=100)) == [b'1:500000']
+    assert list(seqset.split([])) == []
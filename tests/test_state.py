@@ -0,0 +1,141 @@
+from norless.state import SqliteState
+
+
+def test_folder_status_is_stored_per_folder(tmp_path) -> None:
+    state = SqliteState(str(tmp_path))
+    assert state.modseq('acc', 'INBOX') is None
+
+    state.set_folder('acc', 'INBOX', 10)
+    assert state.modseq('acc', 'INBOX') is None
+
+    state.set_folder_status('acc', 'INBOX', 100, 50, 42)
+    assert state.modseq('acc', 'INBOX') == 42
+    assert state.uidvalidity('acc', 'INBOX') == 10
+    assert state.modseq('acc', 'Sent') is None
+    assert state.folder_info('acc', 'INBOX') == (10, 100, 50, 42)
+    assert state.folder_info('acc', 'Sent') is None
+
+
+def test_status_columns_are_added_to_existing_db(tmp_path) -> None:
+    import sqlite3
+
+    conn = sqlite3.connect(str(tmp_path / 'state.sqlite'))
+    conn.execute('CREATE TABLE folders (account text, folder text, uidvalidity integer)')
+    conn.execute("INSERT INTO folders VALUES ('acc', 'INBOX', 10)")
+    conn.commit()
+    conn.close()
+
+    state = SqliteState(str(tmp_path))
+    state.set_folder_status('acc', 'INBOX', 100, 50, 42)
+    assert state.folder_info('acc', 'INBOX') == (10, 100, 50, 42)
+
+
+def test_reset_uids(tmp_path) -> None:
+    state = SqliteState(str(tmp_path))
+    state.put_message('f1', 'acc', 'INBOX', 1, '<1>', 'h1')
+    state.put_message('f2', 'acc', 'INBOX', 2, '<2>', 'h2')
+
+    state.reset_uids('acc', 'INBOX', [2])
+
+    assert state.by_uid('acc', 'INBOX', 1) is not None
+    assert state.by_uid('acc', 'INBOX', 2) is None
+    assert state.max_uid('acc', 'INBOX') == 1
+
+
+def test_batch_commits_queued_rows_on_exit(tmp_path) -> None:
+    state = SqliteState(str(tmp_path))
+    other = SqliteState(str(tmp_path))
+
+    with state.batch():
+        state.set_folder('acc', 'INBOX', 10)
+        state.put_message('f1', 'acc', 'INBOX', 1, '<1>', 'h1')
+        assert other.uidvalidity('acc', 'INBOX') is None
+        assert other.getall() == []
+
+        # reads see queued rows
+        assert state.max_uid('acc', 'INBOX') == 1
+        state.put_message('f2', 'acc', 'INBOX', 2, '<2>', 'h2')
+
+    assert other.uidvalidity('acc', 'INBOX') == 10
+    assert other.max_uid('acc', 'INBOX') == 2
+
+
+def test_batch_flushes_every_n_rows(tmp_path) -> None:
+    state = SqliteState(str(tmp_path))
+    other = SqliteState(str(tmp_path))
+
+    with state.batch(rows=2):
+        for uid in range(1, 6):
+            state.put_message(f'f{uid}', 'acc', 'INBOX', uid, f'<{uid}>', 'h')
+        assert other.max_uid('acc', 'INBOX') == 4
+
+        with state.batch():
+            state.reset_uids('acc', 'INBOX', [5])
+        assert other.max_uid('acc', 'INBOX') == 4
+
+    assert state.max_uid('acc', 'INBOX') == 4
+    assert len(other.getall()) == 5
+
+
+def test_batch_commits_rows_when_block_fails(tmp_path) -> None:
+    import pytest
+
+    state = SqliteState(str(tmp_path))
+    with pytest.raises(RuntimeError), state.batch():
+        state.put_message('f1', 'acc', 'INBOX', 1, '<1>', 'h1')
+        raise RuntimeError
+
+    assert SqliteState(str(tmp_path)).max_uid('acc', 'INBOX') == 1
+
+
+def test_bulk_lookups(tmp_path) -> None:
+    state = SqliteState(str(tmp_path))
+    state.put_message('f1', 'acc', 'INBOX', 1, '<1>', 'h1')
+    state.put_message('f2', 'acc', 'INBOX', 2, '<2>', 'h2')
+    state.put_message('f3', 'acc', 'INBOX', 3, '<2>', 'h3')
+    state.put_message('f4', 'acc', 'Sent', 4, '<1>', 'h4')
+
+    found = state.by_uids('acc', 'INBOX', [1, 3, 4, 5])
+    assert sorted(found) == [1, 3]
+    assert found[3].fname == 'f3'
+    assert state.by_uids('acc', 'INBOX', []) == {}
+
+    by_msgid = state.by_msgids('acc', 'INBOX', ['<1>', '<2>', '<3>'])
+    assert sorted(by_msgid) == ['<1>', '<2>']
+    assert [it.fname for it in by_msgid['<1>']] == ['f1']
+    assert sorted(it.fname for it in by_msgid['<2>']) == ['f2', 'f3']
+
+
+def test_legacy_db_is_migrated(tmp_path) -> None:
+    import sqlite3
+
+    from norless.state import MIGRATIONS, create_tables
+
+    conn = sqlite3.connect(str(tmp_path / 'state.sqlite'))
+    create_tables(conn)
+    conn.execute("INSERT INTO folders VALUES ('acc', 'INBOX', 10, 42, 100, 50)")
+    conn.execute("INSERT INTO messages VALUES ('f1', 'acc', 'INBOX', 1, '<1>', 'h1')")
+    conn.execute("INSERT INTO messages VALUES ('f2', '', '', 0, '<2>', 'h2')")
+    conn.commit()
+    conn.close()
+
+    state = SqliteState(str(tmp_path))
+    assert state.conn.execute('pragma user_version').fetchone()[0] == len(MIGRATIONS)
+    assert state.folder_info('acc', 'INBOX') == (10, 100, 50, 42)
+    assert state.folder_info('', '') is None
+    assert state.by_uid('acc', 'INBOX', 1) == ('f1', 'acc', 'INBOX', 1, '<1>', 'h1', None)
+    assert state.find_msgids(['<1>', '<2>', '<3>'])['<2>'].fname == 'f2'
+    indexes = state.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='messages' "
+        'AND sql IS NOT NULL'
+    ).fetchall()
+    assert sorted(it[0] for it in indexes) == [
+        'messages_folder_uid_idx',
+        'messages_hash_idx',
+        'messages_msgid_idx',
+    ]
+
+    state.put_message('f3', 'acc', 'Sent', 3, '<3>', 'h3')
+    state = SqliteState(str(tmp_path))
+    assert len(state.getall()) == 3
+    assert state.uidvalidity('acc', 'Sent') is None